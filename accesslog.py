@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import random
+import threading
+import time
+
+
+class BackgroundHandler(QueueHandler):
+    """Hand the records to a thread writing them through `handlers`
+
+    The caller only puts the record in a queue: formatting and file I/O
+    happen in the writer thread. When the queue is full the record is
+    dropped and counted. The thread is started by the first record of each
+    process, so it also works in WSGI workers forked after the import.
+    """
+
+    def __init__(self, *handlers, maxsize=10000):
+        QueueHandler.__init__(self, None)
+        self.__handlers = handlers
+        self.__maxsize = maxsize
+        self.__listener = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+        self.dropped = 0
+
+    def __start(self):
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.__maxsize)
+            self.__listener = QueueListener(self.queue, *self.__handlers)
+            self.__listener.start()
+            self.__pid = os.getpid()
+
+    def prepare(self, record):
+        # same process, the writer thread can format it
+        return record
+
+    def enqueue(self, record):
+        if self.__pid != os.getpid():
+            self.__start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        with self.__lock:
+            if self.__listener and self.__pid == os.getpid():
+                self.__listener.stop()
+            self.__listener = None
+            self.__pid = None
+        QueueHandler.close(self)
+
+    def stats(self):
+        return {
+            "queued": self.queue and self.queue.qsize() or 0,
+            "dropped": self.dropped,
+        }
+
+
+class AccessLog:
+    """Single line access records, with the time spent on each request
+
+    start() is called when the request arrives and log() once answered.
+    Nothing is measured nor formatted when the logger drops INFO records.
+    Only a `sample` fraction of the successful requests is logged, errors
+    always are.
+    """
+
+    FORMAT = "access remote=%s method=%s path=%s q=%s status=%s bytes=%s ms=%.1f sample=%s"
+
+    def __init__(self, logger, sample=1.0):
+        self.logger = logger
+        self.sample = sample
+
+    def start(self):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return None
+        return time.perf_counter()
+
+    def log(self, start, remote, method, path, query, status, size):
+        if start is None:
+            return
+        if status < 400 and self.sample < 1 and random.random() >= self.sample:
+            return
+        self.logger.info(self.FORMAT, remote, method, path, json.dumps(query), status, size, (time.perf_counter() - start) * 1000, self.sample)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at `rate` tokens per second up to `burst`
+
+    Buckets left untouched long enough to be full again are forgotten, so
+    the memory used depends on the number of recent clients only.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+        self.__next_cleanup = time.time()
+        self.rejected = 0
+
+    def take(self, key, cost=1):
+        """take cost tokens from the bucket of key
+
+        return 0 if they were taken, else the seconds to wait for them
+        """
+        now = time.time()
+        with self.__lock:
+            if now >= self.__next_cleanup:
+                self.__cleanup(now)
+            tokens, last = self.__buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            # more than the bucket can ever hold, allowed when it is full
+            cost = min(cost, self.burst)
+            if tokens < cost:
+                self.__buckets[key] = (tokens, now)
+                self.rejected += 1
+                return (cost - tokens) / self.rate
+            self.__buckets[key] = (tokens - cost, now)
+            return 0
+
+    def __cleanup(self, now):
+        full = self.burst / self.rate
+        for key, (tokens, last) in list(self.__buckets.items()):
+            if now - last >= full:
+                del self.__buckets[key]
+        self.__next_cleanup = now + max(full, 60)
+
+    def stats(self):
+        return { "clients": len(self.__buckets), "rejected": self.rejected }
+
+
+class PriorityGate:
+    """At most `limit` holders at once, the waiters served by priority
+
+    Lower priority values go first, in arrival order within a priority.
+    Priorities above 0 are only admitted while more than `reserved` places
+    are free, these are kept for priority 0.
+    """
+
+    def __init__(self, limit, reserved=0):
+        self.limit = limit
+        self.reserved = min(reserved, limit - 1)
+        self.in_flight = 0
+        self.rejected = 0
+        self.__waiters = []
+        self.__order = itertools.count()
+        self.__cond = threading.Condition()
+
+    def __free(self, priority):
+        free = self.limit - self.in_flight
+        if priority > 0:
+            free -= self.reserved
+        return free > 0
+
+    def saturated(self, priority):
+        """whether a request of this priority would have to wait"""
+        with self.__cond:
+            return bool(self.__waiters) or not self.__free(priority)
+
+    def acquire(self, priority=0, timeout=None):
+        with self.__cond:
+            if not self.__waiters and self.__free(priority):
+                self.in_flight += 1
+                return True
+            if not timeout:
+                self.rejected += 1
+                return False
+            me = (priority, next(self.__order))
+            heapq.heappush(self.__waiters, me)
+            deadline = time.time() + timeout
+            while self.__waiters[0] is not me or not self.__free(priority):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.__waiters.remove(me)
+                    heapq.heapify(self.__waiters)
+                    self.rejected += 1
+                    # the next one may fit where this one didn't
+                    self.__cond.notify_all()
+                    return False
+                self.__cond.wait(remaining)
+            heapq.heappop(self.__waiters)
+            self.in_flight += 1
+            self.__cond.notify_all()
+            return True
+
+    def release(self):
+        with self.__cond:
+            self.in_flight -= 1
+            self.__cond.notify_all()
+
+    def stats(self):
+        return { "in_flight": self.in_flight, "waiting": len(self.__waiters), "rejected": self.rejected }
@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+"""Micro-benchmarks of the bird-lg hot paths, run offline on the corpus
+
+    bench/bench.py                      run everything, print the timings
+    bench/bench.py --save               also store them in bench/results/
+    bench/bench.py --compare latest     compare with the last stored run
+    bench/bench.py -k summary -k read   only run the matching benchmarks
+
+With --compare, the exit status is 1 when a benchmark got slower than the
+threshold, so it can be used to gate a deployment.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+benchpath = os.path.dirname(os.path.realpath(__file__))
+sitepath = os.path.dirname(benchpath)
+sys.path.insert(0, sitepath)
+sys.path.insert(0, benchpath)
+
+import corpus
+
+RESULTS_DIR = os.path.join(benchpath, "results")
+
+HOST = "rt1"
+LG_CONFIG = {
+    "ASN_ZONE": False,
+    "PROXY": { HOST: "127.0.0.1:5000" },
+    "ROUTER_IP": { HOST: [ "192.0.2.1", "2001:db8::1" ] },
+    "AS_NUMBER": { HOST: "64500" },
+}
+
+
+def timeit(func, repeat, min_time):
+    """return the per call timings of func, calibrated to run min_time per repeat"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1000000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    timings = [ elapsed / number ]
+    for r in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return number, timings
+
+
+def benchmarks(scale):
+    """yield (name, callable) for every benchmark"""
+    import lg
+    lg.app.config.update(LG_CONFIG)
+
+    replies = {}
+    for version in corpus.VERSIONS:
+        for command in corpus.COMMANDS:
+            for size in corpus.SIZES:
+                payload = corpus.transcript(version, command, size, scale)
+                status, text = corpus.bird_read(payload)
+                if not status:
+                    raise RuntimeError("%s/%s/%s: %s" % (version, command, size, text))
+                replies[(version, command, size)] = (payload, text)
+
+    for (version, command, size), (payload, text) in replies.items():
+        yield "read/%s/%s/%s" % (version, command, size), lambda payload=payload: corpus.bird_read(payload)
+
+    for version in corpus.VERSIONS:
+        for size in corpus.SIZES:
+            res = replies[(version, "show_protocols", size)][1].split("\n")
+            yield "summary/%s/%s" % (version, size), lambda res=res: lg.parse_summary(res)
+
+    for version in corpus.VERSIONS:
+        for command in [ "show_protocols_all", "show_route_all" ]:
+            for size in corpus.SIZES:
+                res = replies[(version, command, size)][1].split("\n")
+
+                def add_links(res=res):
+                    with lg.app.test_request_context("/detail/%s" % HOST):
+                        lg.add_links(res)
+                yield "add_links/%s/%s/%s" % (version, command, size), add_links
+
+    for version in corpus.VERSIONS:
+        for command in [ "show_route_for", "show_route_all" ]:
+            for size in corpus.SIZES:
+                res = replies[(version, command, size)][1].split("\n")
+                yield "as_tree/%s/%s/%s" % (version, command, size), lambda res=res: lg.build_as_tree_from_raw_bird_ouput(HOST, "ipv4", res)
+
+    for version in corpus.VERSIONS:
+        for command in [ "show_route_for", "show_route_all" ]:
+            for size in corpus.SIZES:
+                res = replies[(version, command, size)][1].split("\n")
+                data = { HOST: lg.build_as_tree_from_raw_bird_ouput(HOST, "ipv4", res) }
+                yield "bgpmap_dot/%s/%s/%s" % (version, command, size), lambda data=data: lg.build_bgpmap(data)[0].to_dot()
+
+    if not lg.graphviz.available:
+        sys.stderr.write("pygraphviz not found, skipping render_img benchmarks\n")
+        return
+
+    for version in corpus.VERSIONS:
+        for size in corpus.SIZES:
+            res = replies[(version, "show_route_for", size)][1].split("\n")
+            data = { HOST: lg.build_as_tree_from_raw_bird_ouput(HOST, "ipv4", res) }
+            yield "render_img/%s/%s" % (version, size), lambda data=data: lg.render_img(data)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=sitepath, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results(name, directory=RESULTS_DIR):
+    if name == "latest":
+        files = sorted(glob.glob(os.path.join(directory, "*.json")))
+        if not files:
+            sys.exit("no stored results in %s" % directory)
+        name = files[-1]
+    with open(name) as f:
+        return json.load(f)
+
+
+def compare(previous, results, threshold):
+    """print the change of each benchmark, return the names of the regressions"""
+    regressions = []
+    print("\n%-52s %12s %12s %8s" % ("compared to %s" % previous["meta"]["revision"], "before", "now", "change"))
+    for name, r in results.items():
+        before = previous["results"].get(name)
+        if not before:
+            continue
+        change = (r["min"] - before["min"]) / before["min"]
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-52s %10.3fms %10.3fms %+7.1f%%%s" % (name, before["min"] * 1000, r["min"] * 1000, change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="filters", action="append", default=[], help="only run benchmarks matching this regex")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed repeats (default: %(default)s)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimal duration of a repeat, in seconds (default: %(default)s)")
+    parser.add_argument("--full-routes", type=int, default=corpus.SCALE["show_route_all"]["full"], help="routes in the full table (default: %(default)s)")
+    parser.add_argument("--save", action="store_true", help="store the results in %s" % RESULTS_DIR)
+    parser.add_argument("--compare", metavar="FILE", help="compare with stored results, 'latest' for the last saved run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    scale = dict((k, dict(v)) for k, v in corpus.SCALE.items())
+    scale["show_route_all"]["full"] = args.full_routes
+
+    previous = args.compare and load_results(args.compare) or None
+
+    results = {}
+    for name, func in benchmarks(scale):
+        if args.filters and not any(re.search(f, name) for f in args.filters):
+            continue
+        number, timings = timeit(func, args.repeat, args.min_time)
+        results[name] = {
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "number": number,
+            "repeat": args.repeat,
+        }
+        print("%-52s %10.3fms (median %.3fms, %d loops)" % (name, min(timings) * 1000, statistics.median(timings) * 1000, number))
+        sys.stdout.flush()
+
+    data = {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "full_routes": args.full_routes,
+        },
+        "results": results,
+    }
+
+    if args.save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        filename = os.path.join(RESULTS_DIR, "%s-%s.json" % (time.strftime("%Y%m%d-%H%M%S"), data["meta"]["revision"]))
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        print("\nresults saved to %s" % filename)
+
+    if previous:
+        regressions = compare(previous, results, args.threshold)
+        if regressions:
+            print("\n%d benchmark(s) regressed by more than %d%%" % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+"""A fake bird control socket, replaying the benchmark corpus
+
+It speaks the numeric reply protocol of the bird CLI on a UNIX socket: a
+welcome line on connect, then one reply per command line, one command at a
+time per connection. Replies come from the corpus at the configured size,
+after the configured latency.
+
+    bench/fakebird.py /tmp/bird.ctl --version bird2 --size medium --latency 0.05
+"""
+
+import argparse
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import corpus
+
+WELCOME = {
+    "bird1": b"0001 BIRD 1.6.8 ready.\n",
+    "bird2": b"0001 BIRD 2.0.8 ready.\n",
+}
+
+STATUS = (
+    "1000-BIRD %s\n"
+    "1011-Router ID is 192.0.2.1\n"
+    " Current server time is 2021-06-05 10:00:00.000\n"
+    " Last reboot on %s\n"
+    " Last reconfiguration on %s\n"
+    "0013 Daemon is up and running\n"
+)
+
+
+class FakeBird(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """bird control socket server, replying to commands from the corpus"""
+
+    daemon_threads = True
+
+    def __init__(self, path, version="bird2", size="small", latency=0.0, jitter=0.0, scale=None, serial=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.path = path
+        self.version = version
+        self.size = size
+        self.latency = latency
+        self.jitter = jitter
+        self.scale = scale
+        # like the real daemon, work on one command at a time for all clients
+        self.serial = serial and threading.Lock() or None
+        self.commands = 0
+        self.boot_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.reconfiguration_time = self.boot_time
+        self.__replies = {}
+        self.__lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, path, FakeBirdHandler)
+
+    def reconfigure(self):
+        """pretend bird was reconfigured, as seen in "show status" """
+        self.reconfiguration_time = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def transcript(self, command):
+        with self.__lock:
+            if command not in self.__replies:
+                self.__replies[command] = corpus.transcript(self.version, command, self.size, self.scale)
+            return self.__replies[command]
+
+    def reply(self, cmd):
+        """return the bytes bird would answer to cmd"""
+        words = cmd.split()
+        if words == [ "restrict" ]:
+            return b"0016 Access restricted\n"
+        if words[:2] == [ "show", "status" ]:
+            return (STATUS % (self.version[-1], self.boot_time, self.reconfiguration_time)).encode("utf-8")
+        if words[:2] == [ "show", "protocols" ]:
+            if len(words) > 2 and words[2] == "all":
+                return self.transcript("show_protocols_all")
+            return self.transcript("show_protocols")
+        if words[:3] == [ "show", "route", "for" ]:
+            return self.transcript("show_route_for")
+        if words[:2] == [ "show", "route" ]:
+            return self.transcript("show_route_all")
+        return b"9001 syntax error, unexpected CF_SYM_UNDEFINED\n"
+
+    def shutdown(self):
+        socketserver.UnixStreamServer.shutdown(self)
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class FakeBirdHandler(socketserver.StreamRequestHandler):
+
+    def answer(self, cmd):
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        self.wfile.write(server.reply(cmd))
+
+    def handle(self):
+        server = self.server
+        self.wfile.write(WELCOME[server.version])
+        for line in self.rfile:
+            cmd = line.decode("utf-8", "ignore").strip()
+            if not cmd:
+                continue
+            server.commands += 1
+            if server.serial:
+                with server.serial:
+                    self.answer(cmd)
+            else:
+                self.answer(cmd)
+            self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="path of the UNIX socket to create")
+    parser.add_argument("--version", choices=corpus.VERSIONS, default="bird2")
+    parser.add_argument("--size", choices=corpus.SIZES, default="small")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay before each reply, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay, in seconds")
+    parser.add_argument("--serial", action="store_true", help="answer one command at a time, like bird")
+    args = parser.parse_args()
+
+    server = FakeBird(args.path, args.version, args.size, args.latency, args.jitter, serial=args.serial)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+"""End-to-end load test of lg and lgproxy against a fake bird
+
+Starts a fake bird control socket, N lgproxy processes using it and one lg
+process configured with all those proxies, then sends concurrent page and
+API requests for a while and reports the throughput and the latency
+percentiles of each route.
+
+    bench/loadtest.py --proxies 8 --concurrency 16 --duration 30 --latency 0.02
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import urlopen
+
+benchpath = os.path.dirname(os.path.realpath(__file__))
+sitepath = os.path.dirname(benchpath)
+sys.path.insert(0, benchpath)
+
+import corpus
+from fakebird import FakeBird
+
+PREFIX = "193.0.14.0/23"
+PROTOCOL = "transit_as174"
+
+# route name -> (service, path), the path is relative to that service
+ROUTES = {
+    "summary":       ("lg", "/summary/all"),
+    "detail":        ("lg", "/detail/all?q=%s" % PROTOCOL),
+    "prefix":        ("lg", "/prefix/all?q=%s" % quote(PREFIX)),
+    "prefix_detail": ("lg", "/prefix_detail/all?q=%s" % quote(PREFIX)),
+    "proxy_protocols": ("proxy", "/bird?q=%s" % quote("show protocols")),
+    "proxy_route":   ("proxy", "/bird?q=%s" % quote("show route for %s all" % PREFIX)),
+}
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_port(port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("nothing listening on port %d after %ds" % (port, timeout))
+
+
+def write_config(filename, config):
+    with open(filename, "w") as f:
+        for k, v in config.items():
+            f.write("%s = %r\n" % (k, v))
+
+
+class Fleet:
+    """a fake bird, lgproxy processes in front of it and an lg using them"""
+
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.mkdtemp(prefix="bird-lg-loadtest-")
+        self.processes = []
+        self.proxy_ports = []
+        self.lg_port = None
+        self.bird = None
+
+    def spawn(self, script, envvar, config):
+        cfg = os.path.join(self.tmpdir, "%s-%d.cfg" % (script, config["BIND_PORT"]))
+        write_config(cfg, config)
+        env = dict(os.environ)
+        env[envvar] = cfg
+        log = open(os.path.join(self.tmpdir, "%s-%d.out" % (script, config["BIND_PORT"])), "w")
+        p = subprocess.Popen([sys.executable, os.path.join(sitepath, script)], cwd=sitepath, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(p)
+        return p
+
+    def start(self):
+        args = self.args
+        bird_socket = os.path.join(self.tmpdir, "bird.ctl")
+        self.bird = FakeBird(bird_socket, args.version, args.size, args.latency, args.jitter, serial=args.serial)
+        t = threading.Thread(target=self.bird.serve_forever)
+        t.daemon = True
+        t.start()
+
+        for i in range(args.proxies):
+            port = free_port()
+            self.spawn(args.async_proxy and "lgproxy_async.py" or "lgproxy.py", "LGPROXY_SETTINGS", {
+                "DEBUG": False,
+                "LOG_FILE": os.path.join(self.tmpdir, "lgproxy-%d.log" % port),
+                "LOG_LEVEL": "WARNING",
+                "BIND_IP": "127.0.0.1",
+                "BIND_PORT": port,
+                "ACCESS_LIST": [],
+                "BIRD_SOCKET": bird_socket,
+                "BIRD6_SOCKET": bird_socket,
+                "CACHE_TTL": args.cache_ttl and { "show": args.cache_ttl } or {},
+            })
+            self.proxy_ports.append(port)
+
+        self.lg_port = free_port()
+        self.spawn("lg.py", "LG_SETTINGS", {
+            "DEBUG": False,
+            "LOG_FILE": os.path.join(self.tmpdir, "lg.log"),
+            "LOG_LEVEL": "WARNING",
+            "BIND_IP": "127.0.0.1",
+            "BIND_PORT": self.lg_port,
+            "PROXY": dict(("fake%d" % i, "127.0.0.1:%d" % port) for i, port in enumerate(self.proxy_ports)),
+            "ROUTER_IP": dict(("fake%d" % i, [ "192.0.2.%d" % (i + 1) ]) for i in range(len(self.proxy_ports))),
+            "AS_NUMBER": dict(("fake%d" % i, "64500") for i in range(len(self.proxy_ports))),
+            "ASN_ZONE": False,
+            # all the load comes from one address
+            "RATE_LIMIT": {},
+            "HOST_MAX_INFLIGHT": None,
+        })
+
+        for port in self.proxy_ports + [ self.lg_port ]:
+            wait_port(port)
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        if self.bird:
+            self.bird.shutdown()
+        if self.args.keep:
+            print("logs and configs kept in %s" % self.tmpdir)
+        else:
+            shutil.rmtree(self.tmpdir, True)
+
+    def proxy_metrics(self):
+        """return the sum of the bird counters of every lgproxy"""
+        total = { "requests": 0, "executed": 0 }
+        for port in self.proxy_ports:
+            try:
+                data = json.loads(urlopen("http://127.0.0.1:%d/metrics" % port, None, 5).read().decode("utf-8"))
+            except (HTTPError, IOError, ValueError):
+                continue
+            for stats in data["bird"].values():
+                total["requests"] += stats["requests"]
+                total["executed"] += stats["executed"]
+        return total
+
+    def url(self, route, n):
+        service, path = ROUTES[route]
+        if service == "lg":
+            port = self.lg_port
+        else:
+            port = self.proxy_ports[n % len(self.proxy_ports)]
+        return "http://127.0.0.1:%d%s" % (port, path)
+
+
+def percentile(timings, p):
+    if not timings:
+        return 0.0
+    return timings[min(len(timings) - 1, int(round(p / 100.0 * (len(timings) - 1))))]
+
+
+def run_load(fleet, routes, concurrency, duration, timeout):
+    """request the routes in turn from concurrent clients, return the timings"""
+    stats = dict((route, { "timings": [], "errors": 0 }) for route in routes)
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(n):
+        i = n
+        while time.time() < deadline:
+            route = routes[i % len(routes)]
+            url = fleet.url(route, i)
+            i += 1
+            start = time.perf_counter()
+            try:
+                urlopen(url, None, timeout).read()
+                ok = True
+            except (HTTPError, IOError):
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    stats[route]["timings"].append(elapsed)
+                else:
+                    stats[route]["errors"] += 1
+
+    threads = [ threading.Thread(target=client, args=(n,)) for n in range(concurrency) ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return stats, time.time() - start
+
+
+def report(stats, elapsed):
+    results = {}
+    print("%-16s %8s %7s %9s %9s %9s %9s" % ("route", "requests", "errors", "req/s", "p50", "p95", "p99"))
+    for route, s in stats.items():
+        timings = sorted(s["timings"])
+        r = results[route] = {
+            "requests": len(timings) + s["errors"],
+            "errors": s["errors"],
+            "throughput": len(timings) / elapsed,
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "p99": percentile(timings, 99),
+        }
+        print("%-16s %8d %7d %9.1f %7.1fms %7.1fms %7.1fms" % (route, r["requests"], r["errors"], r["throughput"], r["p50"] * 1000, r["p95"] * 1000, r["p99"] * 1000))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--proxies", type=int, default=4, help="number of lgproxy processes (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=20, help="duration of the load, in seconds (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=60, help="client timeout, in seconds (default: %(default)s)")
+    parser.add_argument("--version", choices=corpus.VERSIONS, default="bird2", help="bird version to emulate")
+    parser.add_argument("--size", choices=corpus.SIZES, default="small", help="size of the bird replies")
+    parser.add_argument("--latency", type=float, default=0.0, help="bird reply latency, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra bird latency, in seconds")
+    parser.add_argument("--serial", action="store_true", help="bird answers one command at a time, like the real daemon")
+    parser.add_argument("--async", dest="async_proxy", action="store_true", help="run lgproxy_async.py instead of lgproxy.py")
+    parser.add_argument("--cache-ttl", type=float, default=0, help="enable the lgproxy cache of show commands with this ttl")
+    parser.add_argument("--route", dest="routes", action="append", choices=sorted(ROUTES), help="routes to request (default: all)")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    parser.add_argument("--keep", action="store_true", help="keep the generated configs and logs")
+    args = parser.parse_args()
+
+    fleet = Fleet(args)
+    try:
+        fleet.start()
+        stats, elapsed = run_load(fleet, args.routes or sorted(ROUTES), args.concurrency, args.duration, args.timeout)
+        metrics = fleet.proxy_metrics()
+    finally:
+        fleet.stop()
+
+    results = report(stats, elapsed)
+    print("bird commands: %d" % fleet.bird.commands)
+    if metrics["requests"]:
+        print("lgproxy commands: %d requested, %d executed (%.1f%% coalesced)" % (metrics["requests"], metrics["executed"], 100.0 * (metrics["requests"] - metrics["executed"]) / metrics["requests"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({ "args": vars(args), "bird_commands": fleet.bird.commands, "lgproxy": metrics, "results": results }, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
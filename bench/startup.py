@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+"""Cold start benchmark of the lg and lgproxy WSGI workers
+
+Each run loads lg.wsgi or lgproxy.wsgi in a fresh interpreter, as a new
+WSGI worker would, and times the import and the first request. The modules
+with the highest own import time are listed with --top.
+
+    bench/startup.py                    print the timings
+    bench/startup.py --save             also store them in bench/results/startup/
+    bench/startup.py --compare latest   compare with the last stored run
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+benchpath = os.path.dirname(os.path.realpath(__file__))
+sitepath = os.path.dirname(benchpath)
+sys.path.insert(0, benchpath)
+
+from bench import compare, git_revision, load_results, RESULTS_DIR
+from loadtest import write_config
+
+STARTUP_RESULTS_DIR = os.path.join(RESULTS_DIR, "startup")
+
+# script, settings variable, url of the first request
+TARGETS = {
+    "lg.wsgi": ("LG_SETTINGS", "/"),
+    "lgproxy.wsgi": ("LGPROXY_SETTINGS", "/metrics"),
+}
+
+# run in the fresh interpreter, prints the timings as json
+WORKER = """
+import json, runpy, sys, time
+start = time.perf_counter()
+application = runpy.run_path(sys.argv[1])["application"]
+imported = time.perf_counter()
+application.test_client().get(sys.argv[2])
+print(json.dumps({ "import": imported - start, "first_request": time.perf_counter() - imported }))
+"""
+
+
+def run_once(script, envvar, url, config):
+    env = dict(os.environ)
+    env[envvar] = config
+    p = subprocess.run([ sys.executable, "-X", "importtime", "-c", WORKER, os.path.join(sitepath, script), url ], cwd=sitepath, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    modules = {}
+    for line in p.stderr.decode("utf-8", "ignore").splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[0].split(":")[1].strip().isdigit():
+            modules[fields[2].strip()] = int(fields[0].split(":")[1]) / 1000000.0
+    return json.loads(p.stdout.decode("utf-8")), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per target (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=0, help="list the N slowest modules to import")
+    parser.add_argument("--save", action="store_true", help="store the results in %s" % STARTUP_RESULTS_DIR)
+    parser.add_argument("--compare", metavar="FILE", help="compare with stored results, 'latest' for the last saved run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    previous = args.compare and load_results(args.compare, STARTUP_RESULTS_DIR) or None
+
+    tmpdir = tempfile.mkdtemp(prefix="bird-lg-startup-")
+    results = {}
+    for script, (envvar, url) in sorted(TARGETS.items()):
+        config = os.path.join(tmpdir, "%s.cfg" % script)
+        write_config(config, { "LOG_FILE": os.path.join(tmpdir, "%s.log" % script), "ACCESS_LIST": [] })
+
+        timings = { "import": [], "first_request": [] }
+        modules = {}
+        for i in range(args.runs):
+            t, m = run_once(script, envvar, url, config)
+            for k in timings:
+                timings[k].append(t[k])
+            for name, elapsed in m.items():
+                modules.setdefault(name, []).append(elapsed)
+
+        for k, values in timings.items():
+            name = "%s/%s" % (k, script)
+            results[name] = { "min": min(values), "median": statistics.median(values), "number": 1, "repeat": args.runs }
+            print("%-52s %10.3fms (median %.3fms, %d runs)" % (name, min(values) * 1000, statistics.median(values) * 1000, args.runs))
+
+        if args.top:
+            for module, values in sorted(modules.items(), key=lambda x: -statistics.median(x[1]))[:args.top]:
+                print("    %-48s %10.3fms" % (module, statistics.median(values) * 1000))
+        sys.stdout.flush()
+
+    data = {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+    if args.save:
+        if not os.path.isdir(STARTUP_RESULTS_DIR):
+            os.makedirs(STARTUP_RESULTS_DIR)
+        filename = os.path.join(STARTUP_RESULTS_DIR, "%s-%s.json" % (time.strftime("%Y%m%d-%H%M%S"), data["meta"]["revision"]))
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        print("\nresults saved to %s" % filename)
+
+    if previous:
+        regressions = compare(previous, results, args.threshold)
+        if regressions:
+            print("\n%d measure(s) regressed by more than %d%%" % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+import importlib.util
+import os
+import queue
+import select
+import subprocess
+import sys
+import threading
+import time
+
+
+class RenderError(Exception):
+    pass
+
+
+def escape(label):
+    label = label.replace("&", "&amp;")
+    label = label.replace(">", "&gt;")
+    label = label.replace("<", "&lt;")
+    return label
+
+
+def quote(value):
+    value = str(value)
+    # html-like labels
+    if value.startswith("<") and value.endswith(">"):
+        return value
+    return '"%s"' % value.replace('"', '\\"').replace("\r", "\\r")
+
+
+def attributes(attrs):
+    return ", ".join("%s=%s" % (k, quote(v)) for k, v in attrs.items())
+
+
+class Graph:
+    """Directed graph of the bgp map
+
+    Node names are interned to integer ids, clusters hold node ids, and each
+    edge keeps the ordered list of its labels (the hosts using it, the one
+    of the preferred path first) until the graph is written.
+    """
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.__ids = {}
+        self.names = []
+        self.nodes = []
+        self.node_cluster = []
+        self.clusters = {}
+        self.__edges = {}
+        self.edges = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.__ids
+
+    def id(self, name):
+        return self.__ids[name]
+
+    def add_cluster(self, name, **attrs):
+        if name not in self.clusters:
+            self.clusters[name] = { "attrs": attrs, "nodes": [] }
+        return name
+
+    def add_node(self, name, cluster=None, **attrs):
+        """add a node if it doesn't exist yet, return its attributes"""
+        if name in self.__ids:
+            return self.nodes[self.__ids[name]]
+        i = self.__ids[name] = len(self.names)
+        self.names.append(name)
+        self.nodes.append(attrs)
+        self.node_cluster.append(cluster)
+        if cluster is not None:
+            self.clusters[cluster]["nodes"].append(i)
+        return attrs
+
+    def node(self, name):
+        return self.nodes[self.__ids[name]]
+
+    def add_edge(self, src, dst, label=None, force=False, **attrs):
+        """add an edge, or merge label in the existing one, return the edge
+
+        An edge is a [source id, destination id, attributes, labels] list.
+        """
+        key = (self.__ids[src], self.__ids[dst])
+        edge = self.__edges.get(key)
+        if force or not edge:
+            edge = [ key[0], key[1], attrs, label and [ label ] or None ]
+            self.edges.append(edge)
+            if not force:
+                self.__edges[key] = edge
+        elif label and edge[3] is not None:
+            labels = edge[3]
+            label_without_star = label.replace("*", "")
+            if "%s*" % label_without_star not in labels:
+                labels = [ label ] + [ l for l in labels if not l.startswith(label_without_star) ]
+                edge[3] = sorted(labels, key=lambda x: x.endswith("*") and -1 or 1)
+        return edge
+
+    def to_dot(self):
+        lines = [ "digraph %s {" % quote(self.name) ]
+        if self.attrs:
+            lines.append("graph [%s];" % attributes(self.attrs))
+        for name, cluster in self.clusters.items():
+            lines.append("subgraph %s {" % quote("cluster_%s" % name))
+            lines.append("graph [%s];" % attributes(cluster["attrs"]))
+            for i in cluster["nodes"]:
+                lines.append("%s [%s];" % (quote(self.names[i]), attributes(self.nodes[i])))
+            lines.append("}")
+        for i, name in enumerate(self.names):
+            if self.node_cluster[i] is None:
+                lines.append("%s [%s];" % (quote(name), attributes(self.nodes[i])))
+        for src, dst, attrs, labels in self.edges:
+            if labels:
+                attrs = dict(attrs, label=escape("\r".join(labels)))
+            lines.append("%s -> %s [%s];" % (quote(self.names[src]), quote(self.names[dst]), attributes(attrs)))
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def svg_renderer(command=("dot", "-Tsvg")):
+    """return a function laying out a dot graph and drawing it to svg
+
+    The layout is done in-process by libgvc through pygraphviz, with the
+    layout program of command.
+    """
+    import pygraphviz
+
+    def render(dot):
+        graph = pygraphviz.AGraph(string=dot.decode("utf-8"))
+        graph.layout(prog=os.path.basename(command[0]))
+        return graph.draw(format="svg")
+    return render
+
+
+def renderer_available():
+    """whether the workers can draw maps, without importing pygraphviz here"""
+    return importlib.util.find_spec("pygraphviz") is not None
+
+
+def worker_main(command):
+    """loop of the worker process: read framed graphs on stdin, write framed svg on stdout"""
+    render = svg_renderer(command)
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        header = stdin.readline()
+        if not header:
+            return
+        dot = stdin.read(int(header))
+        try:
+            status, output = 0, render(dot)
+        except Exception as e:
+            status, output = 1, str(e).encode("utf-8")
+        stdout.write(b"%d %d\n" % (status, len(output)))
+        stdout.write(output)
+        stdout.flush()
+
+
+class GraphvizWorker:
+    """A process kept running to render one graph after the other
+
+    Graphs and svg go through its stdin and stdout, each prefixed by its
+    length. A render taking more than its timeout kills the process, a new
+    one is started for the next graph.
+    """
+
+    def __init__(self, command=("dot", "-Tsvg")):
+        self.__command = list(command)
+        self.__process = None
+
+    def __start(self):
+        self.__process = subprocess.Popen([ sys.executable, os.path.realpath(__file__) ] + self.__command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.__buffer = b""
+
+    def close(self):
+        if self.__process:
+            try:
+                self.__process.kill()
+                self.__process.wait()
+            except OSError:
+                pass
+            self.__process = None
+
+    def __read(self, size, deadline, timeout):
+        """read size bytes, or a line if size is None"""
+        fd = self.__process.stdout.fileno()
+        while True:
+            if size is None and b"\n" in self.__buffer:
+                line, self.__buffer = self.__buffer.split(b"\n", 1)
+                return line
+            if size is not None and len(self.__buffer) >= size:
+                data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+                return data
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([ fd ], [], [], remaining)[0]:
+                self.close()
+                raise RenderError("the map took more than %ss to render" % timeout)
+            data = os.read(fd, 65536)
+            if not data:
+                self.close()
+                raise RenderError("the graphviz worker exited while rendering the map")
+            self.__buffer += data
+
+    def render(self, dot, timeout):
+        if not self.__process or self.__process.poll() is not None:
+            self.__start()
+        dot = dot.encode("utf-8")
+        try:
+            self.__process.stdin.write(b"%d\n" % len(dot))
+            self.__process.stdin.write(dot)
+        except OSError as e:
+            self.close()
+            raise RenderError("the graphviz worker failed: %s" % e)
+
+        deadline = time.time() + timeout
+        status, size = self.__read(None, deadline, timeout).split()
+        output = self.__read(int(size), deadline, timeout)
+        if int(status):
+            raise RenderError("graphviz failed: %s" % output.decode("utf-8", "ignore"))
+        return output
+
+
+class GraphvizPool:
+    """At most `size` GraphvizWorker, used one map at a time each
+
+    Without pygraphviz every render fails at once, rather than forking
+    the graphviz command for each map.
+    """
+
+    def __init__(self, size=2, command=("dot", "-Tsvg")):
+        self.available = renderer_available()
+        self.__workers = queue.Queue()
+        self.__size = size
+        self.__created = 0
+        self.__command = command
+        self.__lock = threading.Lock()
+
+    def render(self, dot, timeout=10):
+        if not self.available:
+            raise RenderError("pygraphviz is not installed, the map can only be drawn by the browser")
+        with self.__lock:
+            if self.__workers.empty() and self.__created < self.__size:
+                self.__created += 1
+                self.__workers.put(GraphvizWorker(self.__command))
+        try:
+            worker = self.__workers.get(timeout=timeout)
+        except queue.Empty:
+            raise RenderError("too many maps being rendered")
+        try:
+            return worker.render(dot, timeout)
+        finally:
+            self.__workers.put(worker)
+
+
+__all__ = [ 'Graph', 'GraphvizWorker', 'GraphvizPool', 'RenderError', 'renderer_available' ]
+
+
+if __name__ == "__main__":
+    worker_main(sys.argv[1:] or [ "dot", "-Tsvg" ])
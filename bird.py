@@ -19,8 +19,13 @@
 #
 ###
 
+import codecs
+import re
 import socket
 import sys
+import threading
+import time
+# asyncio is imported by the async classes only, lgproxy.py doesn't need it
 
 BUFSIZE = 4096
 
@@ -94,6 +99,78 @@ def BirdSocketSingleton(host, port):
         bird_sockets[(host,port)] = s
     return s
 
+
+class BirdError(Exception):
+    """error reply of bird to a streamed command"""
+    pass
+
+
+class BirdReply:
+    """Incremental parser of a bird reply
+
+    feed() it the data read from the socket, it returns None until the end
+    of the reply, then the (status, data) tuple returned by cmd()
+    """
+
+    def __init__(self):
+        self.__decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.__lastline = ""
+        self.__parsed = []
+        self.__body = False
+        # data read after the end of the reply: the connection is out of sync
+        self.trailing = False
+
+    def parse(self, data):
+        """return the text parsed from data, as a list, and the end of the
+        reply: None until it is read, then (status, text to add or error)"""
+        lines = (self.__lastline + self.__decoder.decode(data)).split("\n")
+        self.__lastline = lines.pop()
+
+        parsed = []
+        for i, line in enumerate(lines):
+            code = line[0:4]
+
+            if not line.strip():
+                continue
+            elif code in END_CODES or code == "0000":
+                self.trailing = any(l.strip() for l in lines[i + 1:] + [ self.__lastline ])
+            if code == "0000":
+                return parsed, (True, "")
+            elif code in SUCCESS_CODES:
+                # replies like "show status" end with a success code
+                if parsed or self.__body:
+                    return parsed, (True, line[5:] + "\n")
+                return parsed, (True, SUCCESS_CODES.get(code))
+            elif code in ERROR_CODES:
+                return parsed, (False, ERROR_CODES.get(code))
+            elif code[0] in [ "1", "2"] :
+                parsed.append(line[5:] + "\n")
+            elif code[0] == " ":
+                parsed.append(line[1:] + "\n")
+            elif code[0] == "+": 
+                parsed.append(line[1:])
+            else:
+                parsed.append("<<<unparsable_string(%s)>>>\n"%line)
+
+        self.__body = self.__body or bool(parsed)
+        return parsed, None
+
+    def feed(self, data):
+        parsed, end = self.parse(data)
+        self.__parsed.extend(parsed)
+        if end is None:
+            return None
+        status, text = end
+        if not status:
+            return end
+        return True, "".join(self.__parsed) + text
+
+
+def single_command(cmd):
+    """whether cmd is a single bird command, bird runs each line as one"""
+    return "\n" not in cmd and "\r" not in cmd
+
+
 class BirdSocket:
 
     def __init__(self, host="", port="", file=""):
@@ -125,6 +202,8 @@ class BirdSocket:
             self.__sock = None
 
     def cmd(self, cmd):
+        if not single_command(cmd):
+            return False, "Invalid command"
         cmdle = cmd + "\n"
         try:
             self.__connect()
@@ -137,39 +216,441 @@ class BirdSocket:
             return False, "Bird connection problem: %s" % why
 
     def __read(self):
-        code = "7000" # Not used  in bird
-        parsed_string = ""
-        lastline = ""
+        reply = BirdReply()
+        while True:
+            data = self.__sock.recv(BUFSIZE)
+            if not data:
+                raise socket.error("connection closed by bird")
+            result = reply.feed(data)
+            if result:
+                if reply.trailing:
+                    self.close()
+                return result
+
+    def stream(self, cmd):
+        """send cmd, then yield the text of the reply as it is read
+
+        Nothing is kept once yielded. Raises BirdError on an error reply,
+        socket.error on connection problems.
+        """
+        if not single_command(cmd):
+            raise BirdError("Invalid command")
+        self.__connect()
+        self.__sock.send((cmd + "\n").encode('utf-8'))
+        reply = BirdReply()
+        while True:
+            data = self.__sock.recv(BUFSIZE)
+            if not data:
+                raise socket.error("connection closed by bird")
+            parsed, end = reply.parse(data)
+            if parsed:
+                yield "".join(parsed)
+            if end:
+                status, text = end
+                if not status:
+                    raise BirdError(text)
+                if text.strip():
+                    yield text
+                return
+
+
+class AsyncBirdSocket:
+    """asyncio version of BirdSocket, for UNIX sockets only"""
+
+    def __init__(self, file):
+        self.__file = file
+        self.__reader = None
+        self.__writer = None
+
+    async def __connect(self):
+        if self.__writer:  return
+        import asyncio
+
+        self.__reader, self.__writer = await asyncio.wait_for(asyncio.open_unix_connection(self.__file), 3.0)
+
+        # read welcome message
+        await asyncio.wait_for(self.__reader.readline(), 3.0)
+        await self.cmd("restrict")
+
+    def close(self):
+        if self.__writer:
+            try: self.__writer.close()
+            except: pass
+            self.__reader = self.__writer = None
+
+    async def cmd(self, cmd):
+        import asyncio
+        # the rest would be answered to the next command of the connection
+        if not single_command(cmd):
+            return False, "Invalid command"
+        cmdle = cmd + "\n"
+        try:
+            await self.__connect()
+            self.__writer.write(cmdle.encode('utf-8'))
+            await self.__writer.drain()
+            return await self.__read()
+        except (OSError, asyncio.TimeoutError):
+            why = str(sys.exc_info()[1]) or "timeout"
+            self.close()
+            return False, "Bird connection problem: %s" % why
+
+    async def stream(self, cmd):
+        """async version of BirdSocket.stream()
+
+        Raises BirdError on an error reply, OSError or asyncio.TimeoutError
+        on connection problems.
+        """
+        import asyncio
+        if not single_command(cmd):
+            raise BirdError("Invalid command")
+        await self.__connect()
+        self.__writer.write((cmd + "\n").encode('utf-8'))
+        await self.__writer.drain()
+        reply = BirdReply()
+        while True:
+            data = await asyncio.wait_for(self.__reader.read(BUFSIZE), 3.0)
+            if not data:
+                raise ConnectionError("connection closed by bird")
+            parsed, end = reply.parse(data)
+            if parsed:
+                yield "".join(parsed)
+            if end:
+                status, text = end
+                if not status:
+                    raise BirdError(text)
+                if text.strip():
+                    yield text
+                return
+
+    async def __read(self):
+        import asyncio
+        reply = BirdReply()
+        while True:
+            data = await asyncio.wait_for(self.__reader.read(BUFSIZE), 3.0)
+            if not data:
+                raise ConnectionError("connection closed by bird")
+            result = reply.feed(data)
+            if result:
+                if reply.trailing:
+                    self.close()
+                return result
+
+
+class CoalescingBirdSocket:
+    """Thread safe access to one bird socket, sharing identical commands
+
+    When a command is already running on the socket, threads sending the
+    same command wait for it and all get its result, instead of queueing
+    another execution of it behind it in bird.
+    """
+
+    def __init__(self, file):
+        self.__file = file
+        self.__lock = threading.Lock()
+        self.__inflight = {}
+        self.requests = 0
+        self.executed = 0
+
+    def cmd(self, cmd):
+        with self.__lock:
+            self.requests += 1
+            call = self.__inflight.get(cmd)
+            leader = call is None
+            if leader:
+                call = self.__inflight[cmd] = { "done": threading.Event() }
+                self.executed += 1
+
+        if not leader:
+            call["done"].wait()
+            return call["result"]
+
+        b = BirdSocket(file=self.__file)
+        try:
+            call["result"] = b.cmd(cmd)
+        except Exception:
+            call["result"] = False, "Bird connection problem: %s" % sys.exc_info()[1]
+            raise
+        finally:
+            b.close()
+            with self.__lock:
+                del self.__inflight[cmd]
+            call["done"].set()
+        return call["result"]
 
-        while code not in END_CODES:
-            data = self.__sock.recv(BUFSIZE).decode('utf-8')
+    def stats(self):
+        return coalescing_stats(self.requests, self.executed)
 
-            lines = (lastline + data).split("\n")
-            if len(data) == BUFSIZE:
-                lastline = lines[-1]
-                lines = lines[:-1]
 
-            for line in lines:
-                code = line[0:4]
+class AsyncBirdQueue:
+    """Command queue of one bird socket
 
-                if not line.strip():
+    The bird CLI runs one command at a time per connection: queued commands
+    are run in order by `connections` persistent connections. cmd() answers
+    at once with an error when more than `maxsize` commands are waiting.
+
+    A command identical to one already queued or running is not queued
+    again, its caller gets the result of the pending one.
+    """
+
+    def __init__(self, file, connections=1, maxsize=0):
+        self.__file = file
+        self.__connections = connections
+        self.__queue = None
+        self.__maxsize = maxsize
+        self.__workers = []
+        self.__inflight = {}
+        self.requests = 0
+        self.executed = 0
+
+    def __start(self):
+        import asyncio
+        self.__queue = asyncio.Queue(self.__maxsize)
+        for i in range(self.__connections):
+            self.__workers.append(asyncio.ensure_future(self.__worker()))
+
+    async def __worker(self):
+        sock = AsyncBirdSocket(self.__file)
+        try:
+            while True:
+                cmd, future = await self.__queue.get()
+                # every client went away while the command was queued
+                if future.done():
                     continue
-                elif code == "0000":
-                    return True, parsed_string
-                elif code in list(SUCCESS_CODES.keys()):
-                    return True, SUCCESS_CODES.get(code)
-                elif code in list(ERROR_CODES.keys()):
-                    return False, ERROR_CODES.get(code)
-                elif code[0] in [ "1", "2"] :
-                    parsed_string += line[5:] + "\n"
-                elif code[0] == " ":
-                    parsed_string += line[1:] + "\n"
-                elif code[0] == "+": 
-                    parsed_string += line[1:]
-                else:
-                    parsed_string += "<<<unparsable_string(%s)>>>\n"%line
-
-        return True, parsed_string
-
-
-__all__ = ['BirdSocketSingleton' , 'BirdSocket' ]
+                try:
+                    result = await sock.cmd(cmd)
+                except Exception:
+                    sock.close()
+                    result = False, "Bird connection problem: %s" % sys.exc_info()[1]
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            sock.close()
+
+    def qsize(self):
+        return self.__queue and self.__queue.qsize() or 0
+
+    def __forget(self, cmd, future):
+        if self.__inflight.get(cmd, (None,))[0] is future:
+            del self.__inflight[cmd]
+
+    async def cmd(self, cmd):
+        import asyncio
+        if not self.__queue:
+            self.__start()
+
+        call = self.__inflight.get(cmd)
+        if not call:
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.__queue.put_nowait((cmd, future))
+            except asyncio.QueueFull:
+                return False, "Too many queued commands for %s" % self.__file
+            self.executed += 1
+            # [future, number of callers waiting for it]
+            call = self.__inflight[cmd] = [ future, 0 ]
+            future.add_done_callback(lambda f: self.__forget(cmd, f))
+
+        self.requests += 1
+        future = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            call[1] -= 1
+            if not call[1]:
+                future.cancel()
+            raise
+
+    def stats(self):
+        return coalescing_stats(self.requests, self.executed)
+
+    def close(self):
+        for worker in self.__workers:
+            worker.cancel()
+        self.__workers = []
+        self.__queue = None
+        self.__inflight = {}
+
+
+class BirdResultCache:
+    """Cache of bird answers, flushed when bird is restarted or reconfigured
+
+    ttls maps command prefixes to the number of seconds their answers are
+    kept, the longest matching prefix applies and commands matching none are
+    not cached. The caller runs "show status" when check_due() says so and
+    passes its answer to update_status(): the cache is flushed when the last
+    reboot or reconfiguration time changes, or bird can't be reached.
+    """
+
+    def __init__(self, ttls, status_interval=2, size=1000):
+        self.__ttls = sorted(ttls.items(), key=lambda i: -len(i[0]))
+        self.__status_interval = status_interval
+        self.__size = size
+        self.__entries = {}
+        self.__lock = threading.RLock()
+        self.__checked = 0
+        self.__status = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    @staticmethod
+    def key(cmd):
+        """the same command however it is spaced"""
+        return " ".join(cmd.split())
+
+    def ttl(self, cmd):
+        cmd = self.key(cmd)
+        for prefix, ttl in self.__ttls:
+            if cmd.startswith(prefix):
+                return ttl
+        return 0
+
+    def check_due(self):
+        """return True if the caller should check "show status" now"""
+        with self.__lock:
+            now = time.time()
+            if now - self.__checked < self.__status_interval:
+                return False
+            self.__checked = now
+            return True
+
+    def update_status(self, status, text):
+        if status:
+            status = tuple(line.strip() for line in text.split("\n") if line.strip().startswith(("Last reboot", "Last reconfiguration")))
+        else:
+            status = None
+        with self.__lock:
+            if status is None or status != self.__status:
+                self.__status = status
+                self.flush()
+
+    def flush(self):
+        with self.__lock:
+            if self.__entries:
+                self.flushes += 1
+            self.__entries = {}
+            self.generation += 1
+
+    def get(self, cmd):
+        entry = self.__entries.get(self.key(cmd))
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, cmd, result, generation):
+        """store result, unless the cache was flushed since generation"""
+        ttl = self.ttl(cmd)
+        if not ttl or not result[0]:
+            return
+        with self.__lock:
+            if generation != self.generation:
+                return
+            now = time.time()
+            if len(self.__entries) >= self.__size:
+                self.__entries = dict((k, v) for k, v in self.__entries.items() if v[0] > now)
+            if len(self.__entries) >= self.__size:
+                del self.__entries[next(iter(self.__entries))]
+            self.__entries[self.key(cmd)] = (now + ttl, result)
+
+    def stats(self):
+        return {
+            "entries": len(self.__entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+        }
+
+
+ROUTE_HEADER = re.compile(r"^(\S+)?\s+(.*?)\s*\[(\S+)\s*([^\]]*)\]\s*(\*)?\s*(?:\((\d+)[^)]*\))?\s*(?:\[(.*)\])?")
+
+class RouteParser:
+    """Incremental parser of a "show route all" reply
+
+    feed() it the text of the reply in pieces of any size, it returns the
+    routes completed by each piece; close() returns the last one. Only the
+    route being parsed is kept.
+    """
+
+    def __init__(self):
+        self.__table = None
+        self.__prefix = None
+        self.__route = None
+        self.__lastline = ""
+
+    def feed(self, chunk):
+        routes = []
+        lines = (self.__lastline + chunk).split("\n")
+        self.__lastline = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            if line.startswith("Table "):
+                self.__table = line[6:].rstrip(":")
+                continue
+            route = self.__route
+            if line[0] == "\t":
+                if route is None:
+                    continue
+                line = line.strip()
+                key, sep, value = line.partition(": ")
+                if line.startswith("via ") or line.startswith("dev "):
+                    route["via"].append(line)
+                elif sep:
+                    route["attributes"][key] = value
+                continue
+
+            header = ROUTE_HEADER.match(line)
+            if not header:
+                continue
+            if route:
+                routes.append(route)
+            if header.group(1):
+                self.__prefix = header.group(1)
+            nexthop = header.group(2)
+            self.__route = {
+                "table": self.__table,
+                "prefix": self.__prefix,
+                "protocol": header.group(3),
+                "since": header.group(4),
+                "primary": bool(header.group(5)),
+                "preference": header.group(6) and int(header.group(6)),
+                "origin": header.group(7),
+                "type": nexthop.startswith("via ") and "unicast" or nexthop,
+                "via": nexthop.startswith("via ") and [ nexthop ] or [],
+                "attributes": {},
+            }
+        return routes
+
+    def close(self):
+        route, self.__route = self.__route, None
+        return route and [ route ] or []
+
+
+def parse_routes(chunks):
+    """yield one dict per route of a "show route all" reply
+
+    chunks is the text of the reply in pieces of any size, as yielded by
+    BirdSocket.stream().
+    """
+    parser = RouteParser()
+    for chunk in chunks:
+        for route in parser.feed(chunk):
+            yield route
+    for route in parser.close():
+        yield route
+
+
+def coalescing_stats(requests, executed):
+    return {
+        "requests": requests,
+        "executed": executed,
+        "coalesced": requests - executed,
+        "coalescing_ratio": requests and float(requests - executed) / requests or 0.0,
+    }
+
+
+__all__ = ['BirdSocketSingleton' , 'BirdSocket', 'BirdReply', 'BirdError', 'single_command', 'RouteParser', 'parse_routes', 'AsyncBirdSocket', 'CoalescingBirdSocket', 'AsyncBirdQueue', 'BirdResultCache' ]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+from collections import deque
+import threading
+import time
+
+
+class HostHealth:
+    """Health of the lgproxy of one host, as seen from this process
+
+    After `failures` consecutive failed requests the circuit opens: the host
+    is considered unreachable and callers should fail at once. A background
+    thread then calls probe() every `probe_interval` seconds, and closes the
+    circuit again as soon as it doesn't raise.
+
+    The latency of successful requests is tracked to adapt the timeout of
+    the next ones to what is usual for this host, and to tell when a request
+    is late compared to the last ones.
+    """
+
+    def __init__(self, host, probe, failures=3, probe_interval=10, min_timeout=5, **kwargs):
+        self.host = host
+        self.__probe = probe
+        self.__failures = failures
+        self.__probe_interval = probe_interval
+        self.__min_timeout = min_timeout
+        self.__lock = threading.Lock()
+        self.__prober = None
+        self.consecutive_failures = 0
+        self.down_since = None
+        self.last_error = ""
+        # smoothed latency and its mean deviation, as for TCP retransmits
+        self.latency = None
+        self.deviation = 0.0
+        self.samples = deque(maxlen=100)
+
+    def is_down(self):
+        return self.down_since is not None
+
+    def error(self):
+        return 'Host "%s" unreachable since %s: %s' % (self.host, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.down_since)), self.last_error)
+
+    def timeout(self, max_timeout):
+        """return the timeout to use for the next request to this host"""
+        if self.latency is None:
+            return max_timeout
+        return min(max_timeout, max(self.__min_timeout, self.latency + 4 * self.deviation))
+
+    def percentile(self, p):
+        """return the p-th percentile of the last latencies, None if too few are known"""
+        samples = sorted(self.samples)
+        if len(samples) < 10:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+    def success(self, elapsed):
+        with self.__lock:
+            self.samples.append(elapsed)
+            self.consecutive_failures = 0
+            self.down_since = None
+            if self.latency is None:
+                self.latency = elapsed
+                self.deviation = elapsed / 2
+            else:
+                self.deviation += (abs(elapsed - self.latency) - self.deviation) / 4
+                self.latency += (elapsed - self.latency) / 8
+
+    def failure(self, error):
+        with self.__lock:
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.consecutive_failures < self.__failures or self.down_since is not None:
+                return
+            self.down_since = time.time()
+            if not self.__prober:
+                self.__prober = threading.Thread(target=self.__probe_loop, name="probe-%s" % self.host)
+                self.__prober.daemon = True
+                self.__prober.start()
+
+    def __probe_loop(self):
+        while True:
+            time.sleep(self.__probe_interval)
+            start = time.time()
+            try:
+                self.__probe()
+            except Exception as e:
+                with self.__lock:
+                    self.last_error = str(e)
+                continue
+            with self.__lock:
+                self.__prober = None
+            self.success(time.time() - start)
+            return
+
+    def stats(self):
+        return {
+            "down_since": self.down_since,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "latency": self.latency,
+            "deviation": self.deviation,
+        }
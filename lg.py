@@ -22,35 +22,72 @@
 
 import base64
 from datetime import datetime
-import memcache
+import os
 import subprocess
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import re
+from http.client import HTTPException
+from urllib.error import HTTPError
 from urllib.request import urlopen
 from urllib.parse import quote, unquote
 import json
+import queue
 import random
-
-from toolbox import mask_is_valid, ip_is_valid, ipv6_is_valid, ipv4_is_valid, resolve, resolve_any, save_cache_pickle, load_cache_pickle, unescape
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+
+from admission import TokenBuckets, PriorityGate
+import bgpgraph
+from hosthealth import HostHealth
+from livepoller import SharedPoller
+from profiler import Sampler, RequestProfile, ProfilerBusy, collapsed
+from snapshot import Snapshot
+import toolbox
+from toolbox import mask_is_valid, ip_is_valid, ipv6_is_valid, ipv4_is_valid, resolve, resolve_any, unescape
 #from xml.sax.saxutils import escape
 
-
-import pydot
-from flask import Flask, render_template, jsonify, redirect, session, request, abort, Response, Markup
+from flask import Flask, render_template, jsonify, redirect, session, request, abort, Response, Markup, url_for, g, has_request_context, make_response
 
 app = Flask(__name__)
 app.config.from_pyfile('lg.cfg')
+app.config.from_envvar('LG_SETTINGS', silent=True)
 app.secret_key = app.config["SESSION_KEY"]
 app.debug = app.config["DEBUG"]
 
-file_handler = TimedRotatingFileHandler(filename=app.config["LOG_FILE"], when="midnight")
+# the file is opened by the first record, in the worker process
+file_handler = TimedRotatingFileHandler(filename=app.config["LOG_FILE"], when="midnight", delay=True)
 file_handler.setLevel(getattr(logging, app.config["LOG_LEVEL"].upper()))
 app.logger.addHandler(file_handler)
 
 memcache_server = app.config.get("MEMCACHE_SERVER", "127.0.0.1:11211")
 memcache_expiration = int(app.config.get("MEMCACHE_EXPIRATION", "1296000")) # 15 days by default
-mc = memcache.Client([memcache_server])
+mc = None
+mc_pid = None
+
+# warm start: the caches below are saved in this file and loaded at startup
+snapshots = Snapshot(app.config.get("SNAPSHOT_FILE"), app.config.get("SNAPSHOT_INTERVAL", 60), app.logger)
+
+def restore_dns_cache(content):
+    now = time.time()
+    toolbox.dns_cache.update((key, value) for key, value in content.items() if value[1] > now)
+
+snapshots.register("dns", lambda: dict(toolbox.dns_cache), restore_dns_cache)
+
+def memcache_client():
+    """return the memcache client of this process, created on first use
+
+    A client created before the WSGI server forks its workers would share
+    its connections with them.
+    """
+    global mc, mc_pid
+    if mc is None or mc_pid != os.getpid():
+        import memcache
+        mc = memcache.Client([memcache_server])
+        mc_pid = os.getpid()
+    return mc
 
 def get_asn_from_as(n):
     asn_zone = app.config.get("ASN_ZONE", False)
@@ -93,6 +130,9 @@ def add_links(text):
 
 def set_session(request_type, hosts, proto, request_args):
     """ Store all data from user in the user session """
+    # follow-up fetch of pending hosts by the browser, or api call
+    if request.args.get("partial") or request.args.get("format") == "json":
+        return
     session.permanent = True
     session.update({
         "request_type": request_type,
@@ -120,23 +160,23 @@ def whois_command(query):
     return subprocess.Popen(['whois'] + server + [query], stdout=subprocess.PIPE).communicate()[0].decode('utf-8', 'ignore')
 
 
-def bird_command(host, proto, query):
-    """Alias to bird_proxy for bird service"""
+def bird_command(host, proto, query, priority=None):
+    """Alias to bird_proxy for bird service, or to its aggregator"""
     if app.config.get("UNIFIED_DAEMON", False):
-        return bird_proxy(host, app.config.get("PROTO_DEFAULT", "ipv4"), "bird", query)
-    else:
-        return bird_proxy(host, proto, "bird", query)
-
-
-def bird_proxy(host, proto, service, query):
-    """Retreive data of a service from a running lgproxy on a remote node
+        proto = app.config.get("PROTO_DEFAULT", "ipv4")
+    if host in host_aggregator:
+        answer = { host: Future() }
+        aggregate_command(host_aggregator[host], proto, query, answer, priority)
+        timeout = app.config.get("HOST_QUEUE_TIMEOUT", 2) + 2 * app.config["PROXY_TIMEOUT"].get("bird", 60)
+        try:
+            return answer[host].result(timeout)
+        except FutureTimeoutError:
+            return False, 'Aggregator "%s" did not answer' % host_aggregator[host]
+    return bird_proxy(host, proto, "bird", query, priority)
 
-    First and second arguments are the node and the port of the running lgproxy
-    Third argument is the service, can be "traceroute" or "bird"
-    Last argument, the query to pass to the service
 
-    return tuple with the success of the command and the returned data
-    """
+def proxy_url(host, proto, service, query):
+    """return the lgproxy url of a query, or None if host or proto is invalid"""
 
     path = ""
     if proto == "ipv6":
@@ -148,24 +188,309 @@ def bird_proxy(host, proto, service, query):
     if isinstance(proxyHost, int):
         proxyHost = "%s:%s" % (host, proxyHost)
 
-    if not proxyHost:
+    if not proxyHost or not path:
+        return None
+    return "http://%s/%s?q=%s" % (proxyHost, path, quote(query))
+
+
+hosts_health = {}
+
+def host_health(host, probe_url=None):
+    """return the HostHealth of host, shared by all the threads of this process
+
+    host can also be an aggregator, probed at probe_url.
+    """
+    health = hosts_health.get(host)
+    if not health:
+        config = app.config.get("CIRCUIT_BREAKER", {})
+
+        def probe():
+            url = probe_url or proxy_url(host, "ipv4", "bird", "show status")
+            urlopen(url, None, config.get("probe_timeout", 3)).read()
+
+        health = hosts_health.setdefault(host, HostHealth(host, probe, **config))
+    return health
+
+
+# lgproxy requests running at once, per (host, "bird" or "traceroute")
+hosts_gate = {}
+
+def host_gate(host, service="bird"):
+    """return the PriorityGate of host for service, None if it has no limit
+
+    A traceroute holds its place for as long as it runs, so traceroutes get
+    their own HOST_MAX_TRACEROUTES places instead of the HOST_MAX_INFLIGHT
+    ones of the other requests.
+    """
+    if service == "traceroute":
+        limit, reserved = app.config.get("HOST_MAX_TRACEROUTES"), 0
+    else:
+        service = "bird"
+        limit, reserved = app.config.get("HOST_MAX_INFLIGHT"), app.config.get("HOST_RESERVED_SLOTS", 0)
+    if not limit:
+        return None
+    gate = hosts_gate.get((host, service))
+    if not gate:
+        gate = hosts_gate.setdefault((host, service), PriorityGate(limit, reserved))
+    return gate
+
+
+def bird_proxy(host, proto, service, query, priority=None):
+    """Retreive data of a service from a running lgproxy on a remote node
+
+    First and second arguments are the node and the port of the running lgproxy
+    Third argument is the service, can be "traceroute" or "bird"
+    Fourth argument, the query to pass to the service
+    Last argument, the priority of the request (see request_priority())
+
+    return tuple with the success of the command and the returned data
+    """
+
+    url = proxy_url(host, proto, service, query)
+
+    if not app.config["PROXY"].get(host, ""):
         return False, 'Host "%s" invalid' % host
-    elif not path:
+    elif not url:
         return False, 'Proto "%s" invalid' % proto
     else:
-        url = "http://%s/%s?q=%s" % (proxyHost, path, quote(query))
-        proxy_timeout = app.config["PROXY_TIMEOUT"].get(service, 60)
-
+        health = host_health(host)
+        if health.is_down():
+            return False, health.error()
+
+        if priority is None:
+            priority = request_priority()
+        gate = host_gate(host, service)
+        if gate and not gate.acquire(priority, app.config.get("HOST_QUEUE_TIMEOUT", 2)):
+            return False, 'Host "%s" busy, too many requests' % host
+
+        max_timeout = app.config["PROXY_TIMEOUT"].get(service, 60)
+        proxy_timeout = max_timeout
+        if service == "bird":
+            proxy_timeout = health.timeout(max_timeout)
+
+        start = time.time()
         try:
-            f = urlopen(url, None, proxy_timeout)
+            try:
+                f = urlopen(url, None, proxy_timeout)
+            except IOError:
+                elapsed = time.time() - start
+                if proxy_timeout >= max_timeout or elapsed < proxy_timeout:
+                    raise
+                # only slower than usual for the host: asked again, lgproxy
+                # joins the command still running, until PROXY_TIMEOUT
+                f = urlopen(url, None, max(1, max_timeout - elapsed))
             resultat = f.read().decode('utf-8')
             status = True                # retreive remote status
         except IOError:
             resultat = "Failed retreive url: %s" % url
             status = False
+            health.failure(str(sys.exc_info()[1]))
+        else:
+            if service == "bird":
+                health.success(time.time() - start)
+        finally:
+            if gate:
+                gate.release()
         return status, resultat
 
 
+# hosts queried through an aggregator lgproxy -> its address
+host_aggregator = dict((host, aggregator) for aggregator, hosts in app.config.get("AGGREGATORS", {}).items() for host in hosts)
+
+def aggregate_command(aggregator, proto, query, answers, priority=None):
+    """Run a bird command on several hosts with one request to their aggregator
+
+    answers is a dict of host -> Future, each set to (status, data) as soon
+    as the aggregator sends the answer of its host (see /aggregate in
+    lgproxy.py), or to an error if it can't.
+    """
+
+    service = { "ipv4": "bird", "ipv6": "bird6" }.get(proto)
+    url = "http://%s/aggregate?service=%s&hosts=%s&q=%s" % (aggregator, service, quote("+".join(answers), safe=""), quote(query))
+    error = "Failed retreive url: %s" % url
+    try:
+        health = host_health(aggregator, "http://%s/metrics" % aggregator)
+        if priority is None:
+            priority = request_priority()
+        gate = host_gate(aggregator)
+
+        if not service:
+            error = 'Proto "%s" invalid' % proto
+        elif health.is_down():
+            error = health.error()
+        elif gate and not gate.acquire(priority, app.config.get("HOST_QUEUE_TIMEOUT", 2)):
+            error = 'Aggregator "%s" busy, too many requests' % aggregator
+        else:
+            start = time.time()
+            try:
+                # the timeout applies to each host answer
+                with urlopen(url, None, app.config["PROXY_TIMEOUT"].get("bird", 60)) as f:
+                    for line in f:
+                        answer = json.loads(line.decode("utf-8"))
+                        future = answers.get(answer["host"])
+                        if future and not future.done():
+                            future.set_result((answer["status"], answer["data"]))
+            except (IOError, HTTPException, ValueError, KeyError, TypeError) as e:
+                health.failure(str(e))
+            else:
+                health.success(time.time() - start)
+            finally:
+                if gate:
+                    gate.release()
+    finally:
+        # whatever happened, nobody must wait for these answers forever
+        for future in answers.values():
+            if not future.done():
+                future.set_result((False, error))
+
+
+def proxy_lines(host, proto, service, query, priority=None):
+    """Stream the answer of a lgproxy service line by line, as it is written
+
+    Same arguments as bird_proxy(), the service must support ?stream=1.
+    raise IOError with the message to show if the host can't answer.
+    """
+
+    url = proxy_url(host, proto, service, query)
+    if not url:
+        raise IOError('Host "%s" or proto "%s" invalid' % (host, proto))
+    health = host_health(host)
+    if health.is_down():
+        raise IOError(health.error())
+
+    if priority is None:
+        priority = request_priority()
+    gate = host_gate(host, service)
+    if gate and not gate.acquire(priority, app.config.get("HOST_QUEUE_TIMEOUT", 2)):
+        raise IOError('Host "%s" busy, too many requests' % host)
+
+    try:
+        try:
+            # the timeout applies to each line
+            f = urlopen(url + "&stream=1", None, app.config["PROXY_TIMEOUT"].get(service, 60))
+        except IOError as e:
+            health.failure(str(e))
+            raise IOError("Failed retreive url: %s" % url)
+        with f:
+            for line in f:
+                yield line.decode("utf-8", "ignore").rstrip("\n")
+    finally:
+        if gate:
+            gate.release()
+
+
+proxy_pool = ThreadPoolExecutor(app.config.get("PROXY_THREADS", 32))
+
+# requests still running when their page was rendered, for the follow-up
+# fetch of the browser: (host, proto, query) -> (expiry, [futures])
+pending_requests = {}
+pending_lock = threading.Lock()
+
+def take_pending(host, proto, query):
+    with pending_lock:
+        expiry, futures = pending_requests.pop((host, proto, query), (0, None))
+    if expiry > time.time():
+        return futures
+    return None
+
+def has_pending(host, proto, query):
+    """whether a follow-up for host would find its request still running"""
+    with pending_lock:
+        expiry, futures = pending_requests.get((host, proto, query), (0, None))
+    return expiry > time.time()
+
+def put_pending(host, proto, query, futures):
+    now = time.time()
+    with pending_lock:
+        for key, (expiry, f) in list(pending_requests.items()):
+            if expiry <= now:
+                del pending_requests[key]
+        pending_requests[(host, proto, query)] = (now + app.config["PROXY_TIMEOUT"].get("bird", 60), futures)
+
+
+def bird_command_multi(hosts, proto, query, deadline=None):
+    """Run bird_command on several hosts at once, within the page deadline
+
+    A host slower than HEDGE_PERCENTILE of its usual latency gets a second
+    request if it has a free place, the first successful answer is used.
+    lgproxy joins it to the bird command already running, so it only helps
+    when the first HTTP request is lost or stuck on the way. Hosts that didn't answer
+    when the deadline is reached are left running for a follow-up request.
+
+    return a dict of host -> (status, data), and the list of pending hosts
+    """
+
+    if deadline is None:
+        deadline = time.time() + app.config.get("PAGE_DEADLINE", 5)
+    hedge_percentile = app.config.get("HEDGE_PERCENTILE", None)
+    # the pool threads don't see the request
+    priority = request_priority()
+
+    if app.config.get("UNIFIED_DAEMON", False):
+        proto = app.config.get("PROTO_DEFAULT", "ipv4")
+
+    if has_request_context() and request.args.get("partial"):
+        retry = followup_admission(hosts, proto, query)
+        if retry:
+            abort(make_response(too_many_requests(retry)))
+
+    now = time.time()
+    calls = {}
+    # hosts behind an aggregator, one request per aggregator
+    aggregated = {}
+    for host in hosts:
+        futures = take_pending(host, proto, query)
+        hedge_at = None
+        if not futures and host in host_aggregator:
+            futures = [ Future() ]
+            aggregated.setdefault(host_aggregator[host], {})[host] = futures[0]
+        elif not futures:
+            futures = [ proxy_pool.submit(bird_command, host, proto, query, priority) ]
+            if hedge_percentile:
+                delay = host_health(host).percentile(hedge_percentile)
+                if delay is not None:
+                    hedge_at = now + delay
+        calls[host] = { "futures": futures, "hedge_at": hedge_at }
+    for aggregator, answers in aggregated.items():
+        proxy_pool.submit(aggregate_command, aggregator, proto, query, answers, priority)
+
+    results = {}
+    while calls:
+        for host, call in list(calls.items()):
+            done = [ f for f in call["futures"] if f.done() ]
+            succeeded = [ f for f in done if f.result()[0] ]
+            if succeeded or len(done) == len(call["futures"]):
+                results[host] = (succeeded or done)[0].result()
+                del calls[host]
+
+        now = time.time()
+        if not calls or now >= deadline:
+            break
+
+        for host, call in calls.items():
+            if call["hedge_at"] and now >= call["hedge_at"]:
+                # not at the expense of the other requests to the host
+                gate = host_gate(host)
+                if not gate or not gate.saturated(priority):
+                    call["futures"].append(proxy_pool.submit(bird_command, host, proto, query, priority))
+                call["hedge_at"] = None
+
+        wakeup = min([ deadline ] + [ call["hedge_at"] for call in calls.values() if call["hedge_at"] ])
+        running = [ f for call in calls.values() for f in call["futures"] if not f.done() ]
+        wait(running, max(0, wakeup - now), FIRST_COMPLETED)
+
+    for host, call in calls.items():
+        put_pending(host, proto, query, call["futures"])
+
+    return results, [ host for host in hosts if host in calls ]
+
+
+def pending_url(host):
+    """return the url of the current view for host alone, without touching the session"""
+    args = dict(request.view_args, hosts=host)
+    return url_for(request.endpoint, q=request.args.get("q"), partial=1, **args)
+
+
 @app.context_processor
 def inject_commands():
     commands = [
@@ -174,16 +499,160 @@ def inject_commands():
             ("prefix", "show route for ..."),
             ("prefix_detail", "show route for ... all"),
             ("prefix_bgpmap", "show route for ... (bgpmap)"),
+            ("traceroute", "traceroute ..."),
         ]
     commands_dict = {}
     for id, text in commands:
         commands_dict[id] = text
     return dict(commands=commands, commands_dict=commands_dict)
 
+@app.context_processor
+def inject_pending_url():
+    return dict(pending_url=pending_url)
+
 @app.context_processor
 def inject_all_host():
     return dict(all_hosts="+".join(list(app.config["PROXY"].keys())))
 
+# admission control: lower priorities are served first by the host gates
+REQUEST_PRIORITY = { "page": 0, "api": 1 }
+rate_limits = dict((name, TokenBuckets(**limit)) for name, limit in app.config.get("RATE_LIMIT", {}).items())
+
+def request_class():
+    """return "page" for what a browser shows to a visitor, "api" for the rest"""
+    if request.endpoint == "export" or request.args.get("format") == "json":
+        return "api"
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return "page"
+    if request.accept_mimetypes.best in ("text/html", "application/xhtml+xml", "text/event-stream"):
+        return "page"
+    return "api"
+
+def request_priority():
+    """return the priority of the lgproxy requests made for the current request"""
+    if not has_request_context():
+        return REQUEST_PRIORITY["page"]
+    return g.get("priority", REQUEST_PRIORITY["page"])
+
+def request_hosts():
+    """return the known hosts the current request will query"""
+    args = request.view_args or {}
+    hosts = args.get("hosts", args.get("host", ""))
+    if hosts == "all":
+        return list(app.config["PROXY"].keys())
+    return [ host for host in hosts.split("+") if host in app.config["PROXY"] ]
+
+def request_cost(hosts):
+    """return the tokens taken by the current request, one per lgproxy request it starts"""
+    if request.endpoint == "summary_events":
+        # a single poller per host, whatever the number of watchers
+        return 1
+    if request.endpoint == "traceroute":
+        # the page only, traceroute_events() pays for the traceroutes
+        return 1
+    if request.args.get("partial"):
+        # follow-up of a page, see followup_admission()
+        return 0
+    return max(1, len(hosts))
+
+def followup_admission(hosts, proto, query):
+    """charge a follow-up for the hosts whose request is no longer running
+
+    The hosts the page left running were paid by it. Called by
+    bird_command_multi(), which knows the command the follow-up runs.
+    return None, or the seconds to wait for enough tokens
+    """
+    buckets = rate_limits.get(request_class())
+    cost = len([ host for host in hosts if not has_pending(host, proto, query) ])
+    if not buckets or not cost:
+        return None
+    return buckets.take(request.remote_addr, cost)
+
+def too_many_requests(retry):
+    retry = int(retry) + 1
+    return "Too many requests, retry in %ss\n" % retry, 429, { "Retry-After": str(retry) }
+
+# sampling profiler, for the addresses of PROFILE_ACCESS_LIST only
+sampler = Sampler(app.config.get("PROFILE_INTERVAL", 0.01))
+
+def profile_allowed():
+    return request.remote_addr in app.config.get("PROFILE_ACCESS_LIST", [])
+
+@app.before_request
+def start_profile():
+    """with ?profile=1, sample the thread of this request until it is answered"""
+    if request.args.get("profile") and profile_allowed():
+        g.profile = RequestProfile(sampler, app.config.get("PROFILE_MAX_SECONDS", 30))
+
+@app.after_request
+def profile_answer(response):
+    profile = g.pop("profile", None)
+    if not profile:
+        return response
+    try:
+        stacks = profile.stop()
+    except ProfilerBusy as e:
+        return Response(str(e), 409, mimetype="text/plain")
+    # the page itself is dropped
+    return Response(collapsed(stacks), mimetype="text/plain", headers={ "X-Profile-Status": str(response.status_code) })
+
+@app.teardown_request
+def stop_profile(exception):
+    # the request failed before being answered
+    profile = g.pop("profile", None)
+    if profile:
+        try:
+            profile.stop()
+        except ProfilerBusy:
+            # nothing was sampled, and nobody to tell
+            pass
+
+@app.route("/profile")
+def profile():
+    """sample all the threads of this process for ?seconds=N, as collapsed stacks"""
+    if not profile_allowed():
+        abort(401)
+    try:
+        seconds = min(float(request.args.get("seconds", 10)), app.config.get("PROFILE_MAX_SECONDS", 30))
+    except ValueError:
+        abort(400)
+    try:
+        stacks = sampler.sample(seconds)
+    except ProfilerBusy as e:
+        return str(e), 409
+    return Response(collapsed(stacks), mimetype="text/plain")
+
+@app.before_request
+def start_snapshots():
+    # in the worker process, once
+    snapshots.start()
+
+@app.before_request
+def admission():
+    """refuse at once the requests over the limits, see RATE_LIMIT in lg.cfg"""
+    if request.endpoint in (None, "static"):
+        return None
+    request_type = request_class()
+    g.priority = REQUEST_PRIORITY[request_type]
+    hosts = request_hosts()
+
+    buckets = rate_limits.get(request_type)
+    if buckets:
+        retry = buckets.take(request.remote_addr, request_cost(hosts))
+        if retry:
+            return too_many_requests(retry)
+
+    # api requests don't queue behind the pages on a busy host
+    if g.priority > REQUEST_PRIORITY["page"]:
+        for host in hosts:
+            if request.endpoint == "traceroute_events":
+                gate = host_gate(host, "traceroute")
+            else:
+                gate = host_gate(host_aggregator.get(host, host))
+            if gate and gate.saturated(g.priority):
+                return too_many_requests(1)
+    return None
+
 @app.route("/")
 def hello():
     if app.config.get("UNIFIED_DAEMON", False):
@@ -208,6 +677,62 @@ def get_query():
     q = unquote(request.args.get('q', '').strip())
     return q
 
+@app.route("/export/<host>")
+@app.route("/export/<host>/<proto>")
+def export(host, proto="ipv4"):
+    """stream the routes of host as json lines, from its lgproxy /export
+
+    The blocks are passed as they come, compressed or not (?gzip=1), so
+    the memory used doesn't depend on the size of the table.
+    """
+    if request.remote_addr not in app.config.get("EXPORT_ACCESS_LIST", []):
+        abort(401)
+    if app.config.get("UNIFIED_DAEMON", False):
+        proto = app.config.get("PROTO_DEFAULT", "ipv4")
+
+    url = proxy_url(host, proto, "export", get_query())
+    if not url:
+        abort(404)
+    health = host_health(host)
+    if health.is_down():
+        return health.error(), 503
+    if request.args.get("gzip"):
+        url += "&gzip=1"
+
+    # held until the whole table is sent
+    gate = host_gate(host)
+    if gate and not gate.acquire(request_priority()):
+        return too_many_requests(1)
+
+    try:
+        f = urlopen(url, None, app.config["PROXY_TIMEOUT"].get("export", 60))
+    except IOError as e:
+        if gate:
+            gate.release()
+        if isinstance(e, HTTPError):
+            return "lgproxy of %s answered %s" % (host, e), e.code
+        health.failure(str(e))
+        return "Failed retreive url: %s" % url, 502
+
+    def stream():
+        try:
+            while True:
+                block = f.read(65536)
+                if not block:
+                    return
+                yield block
+        finally:
+            f.close()
+
+    headers = {}
+    if f.headers.get("Content-Encoding"):
+        headers["Content-Encoding"] = f.headers["Content-Encoding"]
+    response = Response(stream(), mimetype="application/x-ndjson", headers=headers)
+    if gate:
+        response.call_on_close(gate.release)
+    return response
+
+
 @app.route("/whois")
 def whois():
     query = get_query()
@@ -225,6 +750,119 @@ def whois():
     output = whois_command(query).replace("\n", "<br>")
     return jsonify(output=output, title=query)
 
+def traceroute_target(query, proto):
+    """return the proto and the address to traceroute, resolved if needed
+
+    raise ValueError with the message to show if it is invalid
+    """
+    if app.config.get("UNIFIED_DAEMON", False):
+        if not ip_is_valid(query):
+            try:
+                query = resolve_any(query)
+            except:
+                raise ValueError("%s is unresolvable" % query)
+        return ipv6_is_valid(query) and "ipv6" or "ipv4", query
+
+    if proto == "ipv6" and not ipv6_is_valid(query):
+        try:
+            query = resolve(query, "AAAA")
+        except:
+            raise ValueError("%s is unresolvable or invalid for %s" % (query, proto))
+    if proto == "ipv4" and not ipv4_is_valid(query):
+        try:
+            query = resolve(query, "A")
+        except:
+            raise ValueError("%s is unresolvable or invalid for %s" % (query, proto))
+    return proto, query
+
+
+@app.route("/traceroute/<hosts>")
+@app.route("/traceroute/<hosts>/<proto>")
+def traceroute(hosts, proto="ipv4"):
+    """the page only, the browser gets the hops from traceroute_events()"""
+    query = get_query()
+    if not query:
+        abort(400)
+    set_session("traceroute", hosts, proto, query)
+    try:
+        traceroute_target(query, proto)
+    except ValueError as e:
+        return error_page(str(e))
+
+    hosts = hosts.split("+")
+    if hosts == ["all"]:
+        hosts = list(app.config["PROXY"].keys())
+    infos = dict((host, "") for host in hosts if host in app.config["PROXY"])
+    errors = [ 'Host "%s" invalid' % host for host in hosts if host not in infos ]
+    events = url_for("traceroute_events", hosts="+".join(infos), proto=proto, q=query)
+    return render_template('traceroute.html', infos=infos, errors=errors, events=events)
+
+
+def traceroute_relay(host, proto, query, priority, events, closed):
+    """put the hops of the traceroute from host in events, as they come"""
+    lines = proxy_lines(host, proto, "traceroute", query, priority)
+    try:
+        for line in lines:
+            if closed.is_set():
+                return
+            if line.strip():
+                events.put({ "host": host, "line": line })
+        events.put({ "host": host, "done": True })
+    except IOError as e:
+        events.put({ "host": host, "done": True, "error": str(e) })
+    finally:
+        lines.close()
+
+
+@app.route("/traceroute_events/<hosts>")
+@app.route("/traceroute_events/<hosts>/<proto>")
+def traceroute_events(hosts, proto="ipv4"):
+    """run the traceroute on all hosts at once, stream the hops as server-sent events
+
+    Each host line is sent as { "host": host, "line": line } as soon as its
+    lgproxy writes it, then { "host": host, "done": true } (with "error" if
+    it failed), and { "end": true } when all are done.
+    """
+    hosts = hosts.split("+")
+    if hosts == ["all"]:
+        hosts = list(app.config["PROXY"].keys())
+    hosts = [ host for host in hosts if host in app.config["PROXY"] ]
+    if not hosts or not get_query():
+        abort(404)
+    try:
+        proto, query = traceroute_target(get_query(), proto)
+    except ValueError:
+        abort(400)
+    keepalive = app.config.get("SUMMARY_KEEPALIVE", 15)
+    priority = request_priority()
+
+    def stream():
+        events = queue.Queue()
+        closed = threading.Event()
+        # not in proxy_pool, a traceroute would hold a thread for long
+        for host in hosts:
+            t = threading.Thread(target=traceroute_relay, args=(host, proto, query, priority, events, closed), name="traceroute-%s" % host)
+            t.daemon = True
+            t.start()
+        try:
+            done = 0
+            while done < len(hosts):
+                try:
+                    message = events.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message.get("done"):
+                    done += 1
+                yield "data: %s\n\n" % json.dumps(message)
+            # or the browser would run them again
+            yield "data: %s\n\n" % json.dumps({ "end": True })
+        finally:
+            closed.set()
+
+    return Response(stream(), mimetype="text/event-stream", headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
+
+
 # Array of protocols that will be filtered from the summary listing
 SUMMARY_UNWANTED_PROTOS = ["Kernel", "Static", "Device", "BFD", "Direct", "RPKI"]
 # Array of regular expressions to match against protocol names,
@@ -236,6 +874,42 @@ if len(SUMMARY_UNWANTED_NAMES) > 0 :  # If regex list is not empty
     # combine the unwanted names to a single regex
     COMBINED_UNWANTED_NAMES = '(?:%s)' % '|'.join(SUMMARY_UNWANTED_NAMES)
 
+def parse_summary(res):
+    """Extract the protocol rows from the lines of a "show protocols" output"""
+
+    data = []
+    for line in res[1:]:
+        line = line.strip()
+        if line:
+            split = line.split()
+            if (
+                    len(split) >= 5 and
+                    split[1] not in SUMMARY_UNWANTED_PROTOS and
+                    (COMBINED_UNWANTED_NAMES is None or not re.match(COMBINED_UNWANTED_NAMES, split[0])) # If the list is empty or doesn't match the protocol name
+               ):
+                props = dict()
+                props["name"] = split[0]
+                props["proto"] = split[1]
+                props["table"] = split[2]
+                props["state"] = split[3]
+                props["since"] = split[4]
+
+                if len(split) > 5:
+                    # if bird is configured for 'timeformat protocol iso long'
+                    # then the 5th column contains the time, rather than info
+                    match = re.match(r'\d\d:\d\d:\d\d', split[5])
+                    if match:
+                        props["info"] = ' '.join(split[6:]) if len(split) > 6 else ""
+                    else:
+                        props["info"] = ' '.join(split[5:])
+                else:
+                    props["info"] = ""
+
+                data.append(props)
+
+    return data
+
+
 @app.route("/summary/<hosts>")
 @app.route("/summary/<hosts>/<proto>")
 def summary(hosts, proto="ipv4"):
@@ -246,9 +920,12 @@ def summary(hosts, proto="ipv4"):
     errors = []
     hosts = hosts.split("+")
     if hosts == ["all"]:
-        hosts = app.config["PROXY"].keys()
+        hosts = list(app.config["PROXY"].keys())
+    results, pending = bird_command_multi(hosts, proto, command)
     for host in hosts:
-        ret, res = bird_command(host, proto, command)
+        if host not in results:
+            continue
+        ret, res = results[host]
         res = res.split("\n")
 
         if ret is False:
@@ -259,39 +936,78 @@ def summary(hosts, proto="ipv4"):
             errors.append("%s: bird command failed with error, %s" % (host, "\n".join(res)))
             continue
 
-        data = []
-        for line in res[1:]:
-            line = line.strip()
-            if line:
-                split = line.split()
-                if (
-                        len(split) >= 5 and
-                        split[1] not in SUMMARY_UNWANTED_PROTOS and
-                        (COMBINED_UNWANTED_NAMES is None or not re.match(COMBINED_UNWANTED_NAMES, split[0])) # If the list is empty or doesn't match the protocol name
-                   ):
-                    props = dict()
-                    props["name"] = split[0]
-                    props["proto"] = split[1]
-                    props["table"] = split[2]
-                    props["state"] = split[3]
-                    props["since"] = split[4]
-
-                    if len(split) > 5:
-                        # if bird is configured for 'timeformat protocol iso long'
-                        # then the 5th column contains the time, rather than info
-                        match = re.match(r'\d\d:\d\d:\d\d', split[5])
-                        if match:
-                            props["info"] = ' '.join(split[6:]) if len(split) > 6 else ""
-                        else:
-                            props["info"] = ' '.join(split[5:])
-                    else:
-                        props["info"] = ""
+        summary[host] = parse_summary(res)
+        summary_tables[(host, proto)] = (time.time(), summary[host])
 
-                    data.append(props)
+    return render_template('summary.html', summary=summary, command=command, errors=errors, pending=pending)
 
-        summary[host] = data
 
-    return render_template('summary.html', summary=summary, command=command, errors=errors)
+# last "show protocols" of each host: (host, proto) -> (time, rows)
+summary_tables = {}
+
+def restore_summary_tables(content):
+    summary_tables.update((key, value) for key, value in content.items() if key[0] in app.config["PROXY"])
+
+snapshots.register("summary", lambda: dict(summary_tables), restore_summary_tables)
+
+summary_pollers = {}
+summary_pollers_lock = threading.Lock()
+
+def summary_poller(host, proto):
+    """return the poller of "show protocols" on host, shared by all the watchers"""
+    with summary_pollers_lock:
+        poller = summary_pollers.get((host, proto))
+        if not poller:
+            def fetch():
+                ret, res = bird_command(host, proto, "show protocols")
+                res = res.split("\n")
+                if ret is False:
+                    raise IOError(res[0])
+                if len(res) <= 1:
+                    raise IOError("%s: bird command failed with error, %s" % (host, "\n".join(res)))
+                rows = parse_summary(res)
+                summary_tables[(host, proto)] = (time.time(), rows)
+                return rows
+
+            poller = summary_pollers[(host, proto)] = SharedPoller(host, fetch, app.config.get("SUMMARY_POLL_INTERVAL", 5))
+            # the first watchers get the last known table at once
+            if (host, proto) in summary_tables:
+                poller.seed(summary_tables[(host, proto)][1])
+        return poller
+
+
+@app.route("/summary_events/<hosts>")
+@app.route("/summary_events/<hosts>/<proto>")
+def summary_events(hosts, proto="ipv4"):
+    """stream the changes of the summary of hosts, as server-sent events"""
+    hosts = hosts.split("+")
+    if hosts == ["all"]:
+        hosts = list(app.config["PROXY"].keys())
+    hosts = [ host for host in hosts if host in app.config["PROXY"] ]
+    if not hosts:
+        abort(404)
+    keepalive = app.config.get("SUMMARY_KEEPALIVE", 15)
+
+    def stream():
+        events = queue.Queue()
+        pollers = [ summary_poller(host, proto) for host in hosts ]
+        for poller in pollers:
+            poller.subscribe(events)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = events.get(timeout=keepalive)
+                except queue.Empty:
+                    # also how a closed connection is noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield "data: %s\n\n" % json.dumps(message)
+        finally:
+            for poller in pollers:
+                poller.unsubscribe(events)
+
+    return Response(stream(), mimetype="text/event-stream", headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" })
 
 
 @app.route("/detail/<hosts>")
@@ -309,9 +1025,12 @@ def detail(hosts, proto="ipv4"):
     errors = []
     hosts = hosts.split("+")
     if hosts == ["all"]:
-        hosts = app.config["PROXY"].keys()
+        hosts = list(app.config["PROXY"].keys())
+    results, pending = bird_command_multi(hosts, proto, command)
     for host in hosts:
-        ret, res = bird_command(host, proto, command)
+        if host not in results:
+            continue
+        ret, res = results[host]
         res = res.split("\n")
 
         if ret is False:
@@ -324,7 +1043,7 @@ def detail(hosts, proto="ipv4"):
 
         detail[host] = {"status": res[1], "description": add_links(res[2:])}
 
-    return render_template('detail.html', detail=detail, command=command, errors=errors)
+    return render_template('detail.html', detail=detail, command=command, errors=errors, pending=pending)
 
 
 @app.route("/prefix/<hosts>")
@@ -357,19 +1076,34 @@ def get_as_name(_as):
     if not _as.isdigit():
         return _as.strip()
 
-    name = mc.get(str('lg_%s' % _as))
+    name, expiry = asn_names.get(_as, (None, 0))
+    if expiry < time.time():
+        name = memcache_client().get(str('lg_%s' % _as))
     if not name:
         app.logger.info("asn for as %s not found in memcache", _as)
         asn_result = get_asn_from_as(_as)
         if asn_result:
             name = asn_result[-1].replace(" ","\r",1)
-            mc.set(str("lg_%s" % _as), str(name), memcache_expiration)
+            memcache_client().set(str("lg_%s" % _as), str(name), memcache_expiration)
         else:
             return "AS%s" % (_as)
+    if expiry < time.time():
+        asn_names[_as] = (name, time.time() + memcache_expiration)
 
     return "AS%s | %s" % (_as, name)
 
 
+# AS names known by this process, also kept in memcache:
+# as number -> (name, expiry)
+asn_names = {}
+
+def restore_asn_names(content):
+    now = time.time()
+    asn_names.update((asn, value) for asn, value in content.items() if value[1] > now)
+
+snapshots.register("asn", lambda: dict(asn_names), restore_asn_names)
+
+
 def get_as_number_from_protocol_name(host, proto, protocol):
     ret, res = bird_command(host, proto, "show protocols all %s" % protocol)
     re_asnumber = re.search("Neighbor AS:\s*(\d*)", res)
@@ -379,75 +1113,38 @@ def get_as_number_from_protocol_name(host, proto, protocol):
         return "?????"
 
 
-def render_img(data):
-    """return a bgp map in a png file, from the tree"""
+def as_label(name):
+    return '<<TABLE CELLBORDER="0" BORDER="0" CELLPADDING="0" CELLSPACING="0"><TR><TD ALIGN="CENTER">' + bgpgraph.escape(name).replace("\r","<BR/>") + "</TD></TR></TABLE>>"
 
-    graph = pydot.Dot('BGPMAP', graph_type='digraph')
 
-    nodes = {}
-    subgraphs = {}
-    edges = {}
+def build_bgpmap(data):
+    """return the bgp map graph of the tree, and the nodes still to be named"""
+
+    graph = bgpgraph.Graph('BGPMAP')
+    unnamed = []
     prepend_as = {}
 
-    def escape(label):
-        label = label.replace("&", "&amp;")
-        label = label.replace(">", "&gt;")
-        label = label.replace("<", "&lt;")
-        return label
-
-    def add_subgraph(_as, **kwargs):
-        if _as not in subgraphs:
-            subgraphs[_as] = pydot.Cluster("cluster_%s" % _as, label = "", **kwargs)
-            graph.add_subgraph(subgraphs[_as])
-        return subgraphs[_as]
-
-    def add_node(_as, g, **kwargs):
-        if _as not in nodes:
-            if "label" not in kwargs:
-                kwargs["label"] = '<<TABLE CELLBORDER="0" BORDER="0" CELLPADDING="0" CELLSPACING="0"><TR><TD ALIGN="CENTER">' + escape(kwargs.get("label", get_as_name(_as))).replace("\r","<BR/>") + "</TD></TR></TABLE>>"
-            nodes[_as] = pydot.Node(_as, style="filled", fontsize="10", **kwargs)
-            g.add_node(nodes[_as])
-        return nodes[_as]
+    def add_node(_as, cluster=None, **kwargs):
+        if _as not in graph and "label" not in kwargs:
+            unnamed.append(_as)
+        return graph.add_node(_as, cluster, style="filled", fontsize="10", **kwargs)
 
     def add_edge(_previous_as, _as, **kwargs):
-        kwargs["splines"] = "true"
-        force = kwargs.get("force", False)
-
-        edge_tuple = (_previous_as, _as)
-        if force or edge_tuple not in edges:
-            edge = pydot.Edge(*edge_tuple, **kwargs)
-            graph.add_edge(edge)
-            edges[edge_tuple] = edge
-        elif "label" in kwargs and kwargs["label"]:
-            e = edges[edge_tuple]
-
-            label_without_star = kwargs["label"].replace("*", "")
-            if e.get_label() is not None:
-                labels = e.get_label().split("\r")
-            else:
-                return edges[edge_tuple]
-            if "%s*" % label_without_star not in labels:
-                labels = [ kwargs["label"] ]  + [ l for l in labels if not l.startswith(label_without_star) ]
-                labels = sorted(labels, key=lambda x: x.endswith("*") and -1 or 1)
-
-                label = escape("\r".join(labels))
-                e.set_label(label)
-        return edges[edge_tuple]
+        return graph.add_edge(_previous_as, _as, kwargs.pop("label", None), kwargs.pop("force", False), splines="true", **kwargs)[2]
 
     for host, asmaps in data.items():
         as_number = app.config["AS_NUMBER"].get(host, None)
         if as_number:
-            subgraph = add_subgraph(as_number, fillcolor="#F5A9A9")
-            add_node(as_number, subgraph, fillcolor="#F5A9A9")
+            cluster = graph.add_cluster(as_number, label="", fillcolor="#F5A9A9")
+            add_node(as_number, cluster, fillcolor="#F5A9A9")
         else:
-            subgraph = graph
-        add_node(host, subgraph, label = host.upper(), shape="box", fillcolor="#F5A9A9")
+            cluster = None
+        add_node(host, cluster, label = host.upper(), shape="box", fillcolor="#F5A9A9")
         if as_number:
-            edge = add_edge(as_number, nodes[host])
-            edge.set_color("red")
-            edge.set_style("bold")
+            edge = add_edge(as_number, host)
+            edge["color"] = "red"
+            edge["style"] = "bold"
 
-    #colors = [ "#009e23", "#1a6ec1" , "#d05701", "#6f879f", "#939a0e", "#0e9a93", "#9a0e85", "#56d8e1" ]
     previous_as = None
     hosts = list(data.keys())
     for host, asmaps in data.items():
@@ -460,13 +1157,8 @@ def render_img(data):
             hop_label = ""
             for _as in asmap:
                 if _as == previous_as:
-                    if not prepend_as.get(_as, None):
-                        prepend_as[_as] = {}
-                    if not prepend_as[_as].get(host, None):
-                        prepend_as[_as][host] = {}
-                    if not prepend_as[_as][host].get(asmap[0], None):
-                        prepend_as[_as][host][asmap[0]] = 1
-                    prepend_as[_as][host][asmap[0]] += 1
+                    counts = prepend_as.setdefault(_as, {}).setdefault(host, {})
+                    counts[asmap[0]] = counts.get(asmap[0], 1) + 1
 
                 if not hop:
                     hop = True
@@ -478,36 +1170,98 @@ def render_img(data):
                     if first:
                         hop_label = hop_label + "*"
 
-                add_node(_as, graph, fillcolor=("white"))
+                node = add_node(_as, fillcolor="white")
                 if first:
-                    nodes[_as].set_fillcolor("#F5A9A9")
-                if hop_label:
-                    edge = add_edge(nodes[previous_as], nodes[_as], label=hop_label, fontsize="7")
-                else:
-                    edge = add_edge(nodes[previous_as], nodes[_as], fontsize="7")
+                    node["fillcolor"] = "#F5A9A9"
+                edge = add_edge(previous_as, _as, label=hop_label, fontsize="7")
 
                 hop_label = ""
 
                 if first:
-                    edge.set_style("bold")
-                    edge.set_color("red")
-                elif edge.get_color() != "red":
-                    edge.set_style("dashed")
-                    edge.set_color(color)
+                    edge["style"] = "bold"
+                    edge["color"] = "red"
+                elif edge.get("color") != "red":
+                    edge["style"] = "dashed"
+                    edge["color"] = color
 
                 previous_as = _as
             first = False
 
     if previous_as:
-        node = add_node(previous_as, graph)
-        #node.set_shape("box")
+        add_node(previous_as)
 
     for _as in prepend_as:
-       for n in set([ n for h, d in prepend_as[_as].items() for p, n in d.items() ]):
-           graph.add_edge(pydot.Edge(*(_as, _as), label=" %dx" % n, color="grey", fontcolor="grey"))
+        for n in set([ n for h, d in prepend_as[_as].items() for p, n in d.items() ]):
+            graph.add_edge(_as, _as, " %dx" % n, True, color="grey", fontcolor="grey")
+
+    return graph, unnamed
+
+
+graphviz = bgpgraph.GraphvizPool(app.config.get("BGPMAP_WORKERS", 2))
+if app.config.get("BGPMAP_RENDER", "server") == "server" and not graphviz.available:
+    app.logger.warning('pygraphviz is not installed: bgpmaps are drawn by the browser (BGPMAP_RENDER = "client")')
+
+
+def bgpmap_labels(graph, unnamed):
+    """check the size of the map, then return the label of each node"""
+
+    # before any whois lookup or layout
+    max_nodes = app.config.get("BGPMAP_MAX_NODES", 500)
+    max_edges = app.config.get("BGPMAP_MAX_EDGES", 2000)
+    if len(graph) > max_nodes or len(graph.edges) > max_edges:
+        raise bgpgraph.RenderError("the map is too large to be drawn (%d AS, %d links, at most %d and %d)" % (len(graph), len(graph.edges), max_nodes, max_edges))
+
+    labels = dict((name, attrs["label"]) for name, attrs in zip(graph.names, graph.nodes) if "label" in attrs)
+    labels.update(zip(unnamed, proxy_pool.map(get_as_name, unnamed)))
+    return labels
+
+
+def render_img(data):
+    """return a bgp map in a svg file, from the tree"""
 
+    graph, unnamed = build_bgpmap(data)
+    for name, label in bgpmap_labels(graph, unnamed).items():
+        graph.node(name)["label"] = as_label(label)
 
-    return graph.create_svg()
+    return graphviz.render(graph.to_dot(), app.config.get("BGPMAP_TIMEOUT", 10))
+
+
+def bgpmap_json(graph, labels):
+    """return the bgp map as a compact structure, for the browser to draw it
+
+    nodes: [ name, label, kind ], kind is "host", "preferred" or "other"
+    clusters: [ as number, [ node index, ... ] ]
+    edges: [ source index, destination index, color, [ label, ... ] ],
+        preferred paths are red
+    prepends: [ node index, count ]
+    """
+
+    nodes = []
+    for name, attrs in zip(graph.names, graph.nodes):
+        if attrs.get("shape") == "box":
+            kind = "host"
+        elif attrs.get("fillcolor") == "white":
+            kind = "other"
+        else:
+            kind = "preferred"
+        nodes.append([ name, labels.get(name, name), kind ])
+
+    edges = []
+    prepends = []
+    for src, dst, attrs, edge_labels in graph.edges:
+        if src == dst:
+            # the prepend loops carry the count, the others add nothing
+            if attrs.get("color") == "grey":
+                prepends.append([ src, int(edge_labels[0].strip()[:-1]) ])
+        else:
+            edges.append([ src, dst, attrs.get("color", "black"), edge_labels or [] ])
+
+    return {
+        "nodes": nodes,
+        "clusters": [ [ name, cluster["nodes"] ] for name, cluster in graph.clusters.items() ],
+        "edges": edges,
+        "prepends": prepends,
+    }
 
 
 def build_as_tree_from_raw_bird_ouput(host, proto, text):
@@ -670,37 +1424,68 @@ def show_route(request_type, hosts, proto):
     if hosts == ["all"]:
         hosts = list(app.config["PROXY"].keys())
     allhosts = hosts[:]
-    for host in allhosts:
-        ret, res = bird_command(host, proto, command)
-        res = res.split("\n")
-
-        if ret is False:
-            errors.append("%s" % res)
-            continue
-
-        if len(res) <= 1:
-            errors.append("%s: bird command failed with error, %s" % (host, "\n".join(res)))
-            continue
+    pending = []
+    deadline = time.time() + app.config.get("PAGE_DEADLINE", 5)
+    queried = hosts[:]
+    while queried:
+        results, late = bird_command_multi(queried, proto, command, deadline)
+        pending += late
+        discovered = []
+        for host in queried:
+            if host not in results:
+                continue
+            ret, res = results[host]
+            res = res.split("\n")
+
+            if ret is False:
+                errors.append("%s" % res)
+                continue
+
+            if len(res) <= 1:
+                errors.append("%s: bird command failed with error, %s" % (host, "\n".join(res)))
+                continue
+
+            if bgpmap:
+                detail[host] = build_as_tree_from_raw_bird_ouput(host, proto, res)
+                #for internal routes via hosts not selected
+                #add them to the list, but only show preferred route
+                if host not in hosts:
+                    detail[host] = detail[host][:1]
+                for path in detail[host]:
+                    if len(path) == 2:
+                        if (path[1] not in allhosts) and (path[1] in app.config["PROXY"]):
+                            allhosts.append(path[1])
+                            discovered.append(path[1])
 
-        if bgpmap:
-            detail[host] = build_as_tree_from_raw_bird_ouput(host, proto, res)
-            #for internal routes via hosts not selected
-            #add them to the list, but only show preferred route
-            if host not in hosts:
-                detail[host] = detail[host][:1]
-            for path in detail[host]:
-                if len(path) == 2:
-                    if (path[1] not in allhosts) and (path[1] in app.config["PROXY"]):
-                        allhosts.append(path[1])
-
-        else:
-            detail[host] = add_links(res)
+            else:
+                detail[host] = add_links(res)
+        queried = discovered
 
     if bgpmap:
-        img = render_img(detail).decode('utf-8')
-        return render_template('bgpmap.html', img=img, command=command, expression=expression, errors=errors)
+        # the map can't be completed afterwards, just say who is missing
+        for host in pending:
+            errors.append("%s: no answer in time, not on the map" % host)
+        render = request.args.get("format") or app.config.get("BGPMAP_RENDER", "server")
+        if render == "server" and not graphviz.available:
+            render = "client"
+        try:
+            if render == "server":
+                img = render_img(detail).decode('utf-8')
+                return render_template('bgpmap.html', img=img, command=command, expression=expression, errors=errors)
+            graph, unnamed = build_bgpmap(detail)
+            data = bgpmap_json(graph, bgpmap_labels(graph, unnamed))
+        except bgpgraph.RenderError as e:
+            if render == "json":
+                return jsonify(error=str(e), errors=errors), 413
+            return error_page(str(e))
+        if render == "json":
+            return jsonify(bgpmap=data, command=command, expression=expression, errors=errors)
+        return render_template('bgpmap.html', bgpmap=data, command=command, expression=expression, errors=errors)
     else:
-        return render_template('route.html', detail=detail, command=command, expression=expression, errors=errors)
+        return render_template('route.html', detail=detail, command=command, expression=expression, errors=errors, pending=pending)
+
+# before serving anything
+snapshots.load()
 
 if __name__ == "__main__":
     app.run(app.config.get("BIND_IP", "0.0.0.0"), app.config.get("BIND_PORT", 5000))
@@ -20,43 +20,133 @@
 ###
 
 
+import os
 import sys
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from logging import FileHandler
 import subprocess
-from urllib.parse import unquote
+import json
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, unquote
 
-from bird import BirdSocket
+from accesslog import AccessLog, BackgroundHandler
+from bird import BirdSocket, BirdError, single_command, CoalescingBirdSocket, BirdResultCache, parse_routes
+from statehistory import StateHistory, HistorySampler
+from profiler import Sampler, ProfilerBusy, collapsed
 
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, g, Response
+from flask.logging import default_handler
 
 app = Flask(__name__)
 app.debug = app.config["DEBUG"]
 app.config.from_pyfile('lgproxy.cfg')
+app.config.from_envvar('LGPROXY_SETTINGS', silent=True)
 
-file_handler = TimedRotatingFileHandler(filename=app.config["LOG_FILE"], when="midnight") 
+# the file is opened by the first record, in the worker process
+file_handler = TimedRotatingFileHandler(filename=app.config["LOG_FILE"], when="midnight", delay=True)
+file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
 app.logger.setLevel(getattr(logging, app.config["LOG_LEVEL"].upper()))
-app.logger.addHandler(file_handler)
+# written by a background thread, requests never wait for the file (nor
+# for stderr)
+log_handler = BackgroundHandler(file_handler)
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(log_handler)
+access_log = AccessLog(app.logger, app.config.get("ACCESS_LOG_SAMPLE", 1.0))
+
+bird_sockets = {
+    "/bird": CoalescingBirdSocket(app.config.get("BIRD_SOCKET")),
+    "/bird6": CoalescingBirdSocket(app.config.get("BIRD6_SOCKET")),
+}
+
+bird_caches = {}
+if app.config.get("CACHE_TTL"):
+    for path in bird_sockets:
+        bird_caches[path] = BirdResultCache(app.config["CACHE_TTL"], app.config.get("CACHE_STATUS_INTERVAL", 2), app.config.get("CACHE_SIZE", 1000))
+
+# protocol state changes, sampled from each bird socket
+history_sockets = {
+    "/history": ("/bird", "BIRD_SOCKET"),
+    "/history6": ("/bird6", "BIRD6_SOCKET"),
+}
+histories = {}
+histories_pid = None
+histories_lock = threading.Lock()
+
+def start_histories():
+    """open the histories and start their samplers, in the worker process, once
+
+    With HISTORY_FILE, the worker holding the lock of a file samples it and
+    the others read it, until one of them gets the lock when it exits.
+    Without, the history is in the memory of each process: only for a
+    single process server.
+    """
+    global histories_pid
+    if not app.config.get("HISTORY_INTERVAL") or histories_pid == os.getpid():
+        return
+    with histories_lock:
+        if histories_pid == os.getpid():
+            return
+        histories_pid = os.getpid()
+        samplers = {}
+        for path, (bird_path, socket_config) in sorted(history_sockets.items()):
+            socket_file = app.config.get(socket_config)
+            if not socket_file:
+                continue
+            # bird 2 has a single socket for both
+            if socket_file not in samplers:
+                filename = app.config.get("HISTORY_FILE") and "%s.%s" % (app.config["HISTORY_FILE"], bird_path[1:]) or None
+                try:
+                    history = StateHistory(filename, app.config.get("HISTORY_SIZE", 100000))
+                except (IOError, OSError, ValueError) as e:
+                    # ValueError: mapped before the writer sized it.
+                    # Each worker would keep a history of its own
+                    app.logger.error("protocol history of %s disabled: %s", socket_file, e)
+                    samplers[socket_file] = None
+                    continue
+                samplers[socket_file] = HistorySampler(history, bird_sockets[bird_path], app.config["HISTORY_INTERVAL"], app.logger)
+                # in the readers, waits for the lock of the writer
+                samplers[socket_file].start()
+            if samplers[socket_file]:
+                histories[path] = samplers[socket_file].history
+
+@app.before_request
+def start_history_samplers():
+    start_histories()
+
+def history_changes(path, args):
+    """return the /history answer, raise ValueError if the arguments are invalid"""
+    history = histories[path]
+    until = float(args.get("until") or time.time())
+    since = float(args.get("since") or until - 86400)
+    protocol = unquote(args.get("q", "")).strip() or None
+    return { "since": since, "until": until, "oldest": history.oldest(), "protocols": history.query(since, until, protocol) }
 
 @app.before_request
 def access_log_before(*args, **kwargs):
-    app.logger.info("[%s] request %s, %s", request.remote_addr, request.url, "|".join(["%s:%s"%(k,v) for k,v in list(request.headers.items())]))
+    g.access_start = access_log.start()
 
 @app.after_request
 def access_log_after(response, *args, **kwargs):
-    app.logger.info("[%s] reponse %s, %s", request.remote_addr,  request.url, response.status_code)
+    g.access_status = (response.status_code, response.content_length)
     return response
 
+@app.teardown_request
+def access_log_teardown(exception=None):
+    # the after_request functions are not called when the request raised
+    status, size = g.pop("access_status", (500, None))
+    access_log.log(g.get("access_start"), request.remote_addr, request.method, request.path, request.args.get("q", ""), status, size)
+
 def check_accesslist():
     if  app.config["ACCESS_LIST"] and request.remote_addr not in app.config["ACCESS_LIST"]:
         abort(401)
 
-@app.route("/traceroute")
-@app.route("/traceroute6")
-def traceroute():
-    check_accesslist()
-    
+def traceroute_command(path, query):
+    """return the traceroute command line for /traceroute or /traceroute6"""
     if sys.platform.startswith('freebsd') or sys.platform.startswith('netbsd') or sys.platform.startswith('openbsd'):
         traceroute4 = [ 'traceroute' ]
         traceroute6 = [ 'traceroute6' ]
@@ -65,7 +155,7 @@ def traceroute():
         traceroute6 = [ 'traceroute', '-6' ]
 
     src = []
-    if request.path == '/traceroute6': 
+    if path == '/traceroute6': 
         traceroute = traceroute6
         if app.config.get("IPV6_SOURCE",""):
             src = [ "-s",  app.config.get("IPV6_SOURCE") ]
@@ -75,20 +165,40 @@ def traceroute():
         if app.config.get("IPV4_SOURCE",""):
             src = [ "-s",  app.config.get("IPV4_SOURCE") ]
 
-    query = request.args.get("q","")
-    query = unquote(query)
-
     if sys.platform.startswith('freebsd') or sys.platform.startswith('netbsd'):
         options = [ '-a', '-q1', '-w1', '-m15' ]
     elif sys.platform.startswith('openbsd'):
         options = [ '-A', '-q1', '-w1', '-m15' ]
     else: # For Linux
         options = [ '-A', '-q1', '-N32', '-w1', '-m15' ]
-    command = traceroute + src + options + [ query ]
+    return traceroute + src + options + [ query ]
+
+@app.route("/traceroute")
+@app.route("/traceroute6")
+def traceroute():
+    check_accesslist()
+
+    query = request.args.get("q","")
+    query = unquote(query)
+
+    command = traceroute_command(request.path, query)
+    if request.args.get("stream"):
+        return Response(traceroute_lines(command), mimetype="text/plain")
     result = subprocess.Popen( command , stdout=subprocess.PIPE).communicate()[0].decode('utf-8', 'ignore').replace("\n","<br>")
     
     return result
 
+def traceroute_lines(command):
+    """yield the hops as traceroute writes them, stop it if the client leaves"""
+    p = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        for line in p.stdout:
+            yield line
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+
 
 
 @app.route("/bird")
@@ -96,19 +206,219 @@ def traceroute():
 def bird():
     check_accesslist()
 
-    if request.path == "/bird": b = BirdSocket(file=app.config.get("BIRD_SOCKET"))
-    elif request.path == "/bird6": b = BirdSocket(file=app.config.get("BIRD6_SOCKET"))
-    else: return "No bird socket selected"
+    b = bird_sockets.get(request.path)
+    if not b: return "No bird socket selected"
 
     query = request.args.get("q","")
     query = unquote(query)
+    if not single_command(query):
+        abort(400)
+
+    cache = bird_caches.get(request.path)
+    if cache and cache.ttl(query):
+        if cache.check_due():
+            cache.update_status(*b.cmd("show status"))
+        cached = cache.get(query)
+        if cached:
+            return cached[1]
+        generation = cache.generation
+        status, result = b.cmd(query)
+        cache.set(query, (status, result), generation)
+        return result
 
     status, result = b.cmd(query)
-    b.close()
     # FIXME: use status
     return result
 	
 
+export_sockets = {
+    "/export": "BIRD_SOCKET",
+    "/export6": "BIRD6_SOCKET",
+}
+export_slots = threading.BoundedSemaphore(app.config.get("EXPORT_CONCURRENCY", 2))
+
+def export_command(query):
+    """return the "show route ... all" command of an export"""
+    query = query.strip()
+    if query.endswith(" all") or query == "all":
+        query = query[:-3].strip()
+    return ("show route %s all" % query).replace("  ", " ")
+
+def export_records(path, command):
+    """yield the routes of command as json lines, then an error line if bird failed"""
+    b = BirdSocket(file=app.config.get(export_sockets[path]))
+    try:
+        for route in parse_routes(b.stream(command)):
+            yield json.dumps(route, separators=(",", ":")) + "\n"
+    except (BirdError, socket.error) as e:
+        yield json.dumps({ "error": str(e) }) + "\n"
+    finally:
+        b.close()
+
+def batches(lines, size=65536):
+    """group the lines in utf-8 blocks of about size bytes"""
+    batch = []
+    length = 0
+    for line in lines:
+        batch.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(batch).encode("utf-8")
+            batch = []
+            length = 0
+    if batch:
+        yield "".join(batch).encode("utf-8")
+
+def gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/export")
+@app.route("/export6")
+def export():
+    """stream "show route <q> all" as one json record per route"""
+    check_accesslist()
+
+    if not app.config.get(export_sockets[request.path]):
+        return "No bird socket selected"
+    if not export_slots.acquire(False):
+        abort(503)
+
+    command = export_command(unquote(request.args.get("q","")))
+    app.logger.info("export %s", command)
+
+    blocks = batches(export_records(request.path, command))
+    headers = {}
+    if request.args.get("gzip"):
+        blocks = gzipped(blocks)
+        headers["Content-Encoding"] = "gzip"
+    response = Response(blocks, mimetype="application/x-ndjson", headers=headers)
+    # also when the client went away before the first block
+    response.call_on_close(export_slots.release)
+    return response
+
+
+# aggregator mode: lgproxy of other hosts, queried on behalf of lg
+downstream_pool = None
+downstream_pool_pid = None
+downstream_pool_lock = threading.Lock()
+
+def downstream_executor():
+    """return the thread pool of the downstream requests, created on first use
+
+    A pool created before the WSGI server forks its workers would have no
+    threads in them.
+    """
+    global downstream_pool, downstream_pool_pid
+    with downstream_pool_lock:
+        if downstream_pool is None or downstream_pool_pid != os.getpid():
+            downstream_pool = ThreadPoolExecutor(app.config.get("DOWNSTREAM_THREADS", 32))
+            downstream_pool_pid = os.getpid()
+        return downstream_pool
+
+def downstream_url(host, service, query):
+    """return the url of a query to the lgproxy of host, None if unknown"""
+    address = app.config.get("DOWNSTREAM", {}).get(host)
+    if isinstance(address, int):
+        address = "%s:%s" % (host, address)
+    if not address:
+        return None
+    return "http://%s/%s?q=%s" % (address, service, quote(query))
+
+def downstream_command(host, service, query):
+    """return the answer of the lgproxy of host as a json line"""
+    from urllib.request import urlopen
+    url = downstream_url(host, service, query)
+    start = time.time()
+    try:
+        status, data = True, urlopen(url, None, app.config.get("DOWNSTREAM_TIMEOUT", 10)).read().decode("utf-8")
+    except IOError as e:
+        status, data = False, "Failed retreive url: %s (%s)" % (url, e)
+    return json.dumps({ "host": host, "status": status, "data": data, "elapsed": time.time() - start }) + "\n"
+
+def aggregate_lines(hosts, service, query):
+    """yield the answer of each host as soon as it comes"""
+    futures = []
+    for host in hosts:
+        if downstream_url(host, service, query):
+            futures.append(downstream_executor().submit(downstream_command, host, service, query))
+        else:
+            yield json.dumps({ "host": host, "status": False, "data": 'Host "%s" unknown to this aggregator' % host }) + "\n"
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # the client left
+        for future in futures:
+            future.cancel()
+
+@app.route("/aggregate")
+def aggregate():
+    """run a bird command on several downstream hosts, one json line per host"""
+    check_accesslist()
+
+    service = request.args.get("service", "bird")
+    if service not in ("bird", "bird6"):
+        abort(400)
+    # "+" as lg sends it (%2B), or a space if it was decoded as one
+    hosts = request.args.get("hosts", "").replace("+", " ").split()
+    query = unquote(request.args.get("q",""))
+
+    return Response(aggregate_lines(hosts, service, query), mimetype="application/x-ndjson")
+
+
+@app.route("/history")
+@app.route("/history6")
+def history():
+    """state changes of the protocols (or of protocol q) from since to until
+
+    since and until are unix times, the last day by default.
+    """
+    check_accesslist()
+
+    if request.path not in histories:
+        abort(404)
+    try:
+        return jsonify(history_changes(request.path, request.args))
+    except ValueError:
+        abort(400)
+
+
+sampler = Sampler(app.config.get("PROFILE_INTERVAL", 0.01))
+
+def profile_seconds(args):
+    """return the duration asked for a profile, raise ValueError if invalid"""
+    return min(float(args.get("seconds", 10)), app.config.get("PROFILE_MAX_SECONDS", 30))
+
+@app.route("/profile")
+def profile():
+    """sample all the threads of this process for ?seconds=N, as collapsed stacks"""
+    if request.remote_addr not in app.config.get("PROFILE_ACCESS_LIST", []):
+        abort(401)
+    try:
+        stacks = sampler.sample(profile_seconds(request.args))
+    except ValueError:
+        abort(400)
+    except ProfilerBusy as e:
+        return str(e), 409
+    return Response(collapsed(stacks), mimetype="text/plain")
+
+
+@app.route("/metrics")
+def metrics():
+    check_accesslist()
+    return jsonify(
+        bird=dict((path, b.stats()) for path, b in bird_sockets.items()),
+        cache=dict((path, c.stats()) for path, c in bird_caches.items()),
+        history=dict((path, h.stats()) for path, h in histories.items()),
+        log=log_handler.stats(),
+    )
+
+
 if __name__ == "__main__":
     app.logger.info("lgproxy start")
     app.run(app.config.get("BIND_IP", "0.0.0.0"), app.config.get("BIND_PORT", 5000))
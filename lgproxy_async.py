@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+"""asyncio serving mode of lgproxy
+
+Same URLs, configuration and answers as lgproxy.py, but served by a single
+aiohttp event loop: bird commands go through a per-socket command queue on
+persistent CLI connections and traceroutes run as async subprocesses, so a
+slow request no longer holds a worker.
+"""
+
+import asyncio
+import json
+import time
+from urllib.parse import unquote
+import zlib
+
+import aiohttp
+from aiohttp import web
+
+from bird import AsyncBirdQueue, AsyncBirdSocket, BirdError, single_command, BirdResultCache, RouteParser
+from lgproxy import app as flask_app, traceroute_command, export_sockets, export_command, downstream_url, histories, start_histories, history_changes, sampler, profile_seconds, access_log as access_records, log_handler
+from profiler import ProfilerBusy, collapsed
+
+config = flask_app.config
+logger = flask_app.logger
+
+
+@web.middleware
+async def access_log(request, handler):
+    start = access_records.start()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        access_records.log(start, request.remote, request.method, request.path, request.query.get("q", ""), e.status, None)
+        raise
+    except Exception:
+        # answered by aiohttp as a 500
+        access_records.log(start, request.remote, request.method, request.path, request.query.get("q", ""), 500, None)
+        raise
+    access_records.log(start, request.remote, request.method, request.path, request.query.get("q", ""), response.status, response.content_length)
+    return response
+
+
+def check_accesslist(request):
+    if config["ACCESS_LIST"] and request.remote not in config["ACCESS_LIST"]:
+        raise web.HTTPUnauthorized()
+
+
+async def traceroute(request):
+    check_accesslist(request)
+
+    query = request.query.get("q","")
+    query = unquote(query)
+
+    command = traceroute_command(request.path, query)
+    if request.query.get("stream"):
+        return await traceroute_stream(request, command)
+    async with request.app["traceroute_slots"]:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+        result = (await process.communicate())[0].decode('utf-8', 'ignore').replace("\n","<br>")
+
+    return web.Response(text=result, content_type="text/html")
+
+
+async def traceroute_stream(request, command):
+    """send the hops as traceroute writes them, stop it if the client leaves"""
+    response = web.StreamResponse()
+    response.content_type = "text/plain"
+    await response.prepare(request)
+    async with request.app["traceroute_slots"]:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+        try:
+            async for line in process.stdout:
+                await response.write(line)
+        finally:
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+            await process.wait()
+    await response.write_eof()
+    return response
+
+
+async def bird(request):
+    check_accesslist(request)
+
+    queue = request.app["bird_queues"].get(request.path)
+    if not queue:
+        return web.Response(text="No bird socket selected")
+
+    query = request.query.get("q","")
+    query = unquote(query)
+    if not single_command(query):
+        raise web.HTTPBadRequest()
+
+    cache = request.app["bird_caches"].get(request.path)
+    if cache and cache.ttl(query):
+        if cache.check_due():
+            cache.update_status(*(await queue.cmd("show status")))
+        cached = cache.get(query)
+        if cached:
+            return web.Response(text=cached[1], content_type="text/html")
+        generation = cache.generation
+        status, result = await queue.cmd(query)
+        cache.set(query, (status, result), generation)
+        return web.Response(text=result, content_type="text/html")
+
+    status, result = await queue.cmd(query)
+    # FIXME: use status
+    return web.Response(text=result, content_type="text/html")
+
+
+async def export_records(path, command):
+    """yield the routes of command as json lines, then an error line if bird failed"""
+    b = AsyncBirdSocket(config.get(export_sockets[path]))
+    parser = RouteParser()
+    try:
+        async for chunk in b.stream(command):
+            for route in parser.feed(chunk):
+                yield json.dumps(route, separators=(",", ":")) + "\n"
+        for route in parser.close():
+            yield json.dumps(route, separators=(",", ":")) + "\n"
+    except (BirdError, OSError, asyncio.TimeoutError) as e:
+        yield json.dumps({ "error": str(e) or "timeout" }) + "\n"
+    finally:
+        b.close()
+
+
+async def export(request):
+    """stream "show route <q> all" as one json record per route"""
+    check_accesslist(request)
+
+    if not config.get(export_sockets[request.path]):
+        return web.Response(text="No bird socket selected")
+    slots = request.app["export_slots"]
+    if slots.locked():
+        raise web.HTTPServiceUnavailable()
+
+    command = export_command(unquote(request.query.get("q","")))
+    logger.info("export %s", command)
+
+    async with slots:
+        response = web.StreamResponse()
+        response.content_type = "application/x-ndjson"
+        compressor = None
+        if request.query.get("gzip"):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            response.headers["Content-Encoding"] = "gzip"
+        await response.prepare(request)
+
+        # in blocks of about 64kB, as lgproxy.batches()
+        batch = []
+        length = 0
+        async for line in export_records(request.path, command):
+            batch.append(line)
+            length += len(line)
+            if length >= 65536:
+                data = "".join(batch).encode("utf-8")
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    await response.write(data)
+                batch = []
+                length = 0
+        data = "".join(batch).encode("utf-8")
+        if compressor:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            await response.write(data)
+    await response.write_eof()
+    return response
+
+
+async def downstream_command(session, host, service, query):
+    url = downstream_url(host, service, query)
+    start = time.time()
+    try:
+        async with session.get(url) as response:
+            status, data = True, await response.text("utf-8", "ignore")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status, data = False, "Failed retreive url: %s (%s)" % (url, str(e) or "timeout")
+    return { "host": host, "status": status, "data": data, "elapsed": time.time() - start }
+
+
+async def aggregate(request):
+    check_accesslist(request)
+
+    service = request.query.get("service", "bird")
+    if service not in ("bird", "bird6"):
+        raise web.HTTPBadRequest()
+    # "+" as lg sends it (%2B), or a space if it was decoded as one
+    hosts = request.query.get("hosts", "").replace("+", " ").split()
+    query = unquote(request.query.get("q",""))
+
+    response = web.StreamResponse()
+    response.content_type = "application/x-ndjson"
+    await response.prepare(request)
+    tasks = []
+    for host in hosts:
+        if downstream_url(host, service, query):
+            tasks.append(asyncio.ensure_future(downstream_command(request.app["downstream"], host, service, query)))
+        else:
+            await response.write((json.dumps({ "host": host, "status": False, "data": 'Host "%s" unknown to this aggregator' % host }) + "\n").encode("utf-8"))
+    try:
+        for task in asyncio.as_completed(tasks):
+            await response.write((json.dumps(await task) + "\n").encode("utf-8"))
+    finally:
+        for task in tasks:
+            task.cancel()
+    await response.write_eof()
+    return response
+
+
+async def history(request):
+    check_accesslist(request)
+
+    if request.path not in histories:
+        raise web.HTTPNotFound()
+    try:
+        return web.json_response(history_changes(request.path, request.query))
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+
+async def profile(request):
+    if request.remote not in config.get("PROFILE_ACCESS_LIST", []):
+        raise web.HTTPUnauthorized()
+    try:
+        seconds = profile_seconds(request.query)
+    except ValueError:
+        raise web.HTTPBadRequest()
+    # sampled from another thread, the event loop is one of the threads profiled
+    try:
+        stacks = await asyncio.get_event_loop().run_in_executor(None, sampler.sample, seconds)
+    except ProfilerBusy as e:
+        return web.Response(text=str(e), status=409)
+    return web.Response(text=collapsed(stacks), content_type="text/plain")
+
+
+async def metrics(request):
+    check_accesslist(request)
+    return web.json_response({
+        "bird": dict((path, queue.stats()) for path, queue in request.app["bird_queues"].items()),
+        "cache": dict((path, cache.stats()) for path, cache in request.app["bird_caches"].items()),
+        "history": dict((path, h.stats()) for path, h in histories.items()),
+        "log": log_handler.stats(),
+    })
+
+
+async def on_startup(app):
+    start_histories()
+    app["traceroute_slots"] = asyncio.Semaphore(config.get("TRACEROUTE_CONCURRENCY", 4))
+    app["export_slots"] = asyncio.Semaphore(config.get("EXPORT_CONCURRENCY", 2))
+    app["bird_queues"] = {}
+    app["bird_caches"] = {}
+    app["downstream"] = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=config.get("DOWNSTREAM_TIMEOUT", 10)),
+        connector=aiohttp.TCPConnector(limit=config.get("DOWNSTREAM_THREADS", 32)))
+    for path, socket in [ ("/bird", "BIRD_SOCKET"), ("/bird6", "BIRD6_SOCKET") ]:
+        app["bird_queues"][path] = AsyncBirdQueue(config.get(socket), config.get("BIRD_CONNECTIONS", 4), config.get("BIRD_QUEUE_SIZE", 0))
+        if config.get("CACHE_TTL"):
+            app["bird_caches"][path] = BirdResultCache(config["CACHE_TTL"], config.get("CACHE_STATUS_INTERVAL", 2), config.get("CACHE_SIZE", 1000))
+
+
+async def on_cleanup(app):
+    for queue in app["bird_queues"].values():
+        queue.close()
+    await app["downstream"].close()
+
+
+def make_app():
+    app = web.Application(middlewares=[access_log])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_get("/traceroute", traceroute)
+    app.router.add_get("/traceroute6", traceroute)
+    app.router.add_get("/bird", bird)
+    app.router.add_get("/bird6", bird)
+    app.router.add_get("/export", export)
+    app.router.add_get("/export6", export)
+    app.router.add_get("/aggregate", aggregate)
+    app.router.add_get("/history", history)
+    app.router.add_get("/history6", history)
+    app.router.add_get("/profile", profile)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+app = make_app()
+
+
+if __name__ == "__main__":
+    logger.info("lgproxy start (async)")
+    web.run_app(app, host=config.get("BIND_IP", "0.0.0.0"), port=config.get("BIND_PORT", 5000), print=None)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+import threading
+import time
+
+
+class SharedPoller:
+    """Poll one source of rows for all the subscribers watching it
+
+    fetch() returns a list of dicts, identified by their `key` item. A
+    single thread calls it every `interval` seconds as long as someone is
+    subscribed, and puts in each subscriber queue only what changed since
+    the last poll:
+
+        { "name": name, "rows": [ changed or new rows ], "removed": [ keys ] }
+        { "name": name, "error": message }
+
+    A new subscriber first gets all the rows known so far.
+    """
+
+    def __init__(self, name, fetch, interval=5, key="name"):
+        self.name = name
+        self.__fetch = fetch
+        self.__interval = interval
+        self.__key = key
+        self.__lock = threading.Lock()
+        self.__subscribers = set()
+        self.__thread = None
+        self.rows = None
+        self.error = None
+        self.polls = 0
+
+    def subscribe(self, queue):
+        with self.__lock:
+            self.__subscribers.add(queue)
+            if self.rows is not None:
+                queue.put({ "name": self.name, "rows": list(self.rows.values()), "removed": [] })
+            elif self.error:
+                queue.put({ "name": self.name, "error": self.error })
+            if not self.__thread:
+                self.__thread = threading.Thread(target=self.__loop, name="poll-%s" % self.name)
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def seed(self, rows):
+        """start from rows known from elsewhere, until the first poll"""
+        with self.__lock:
+            if self.rows is None:
+                self.rows = dict((row[self.__key], row) for row in rows)
+
+    def unsubscribe(self, queue):
+        with self.__lock:
+            self.__subscribers.discard(queue)
+
+    def subscribers(self):
+        return len(self.__subscribers)
+
+    def __publish(self, message):
+        for queue in list(self.__subscribers):
+            queue.put(message)
+
+    def __poll(self):
+        self.polls += 1
+        try:
+            rows = dict((row[self.__key], row) for row in self.__fetch())
+        except Exception as e:
+            with self.__lock:
+                if self.error != str(e):
+                    self.error = str(e)
+                    self.__publish({ "name": self.name, "error": self.error })
+            return
+
+        with self.__lock:
+            old = self.rows or {}
+            changed = [ row for key, row in rows.items() if old.get(key) != row ]
+            removed = [ key for key in old if key not in rows ]
+            self.rows = rows
+            self.error = None
+            if changed or removed:
+                self.__publish({ "name": self.name, "rows": changed, "removed": removed })
+
+    def __loop(self):
+        while True:
+            with self.__lock:
+                # nobody watching anymore, the next subscriber starts a new thread
+                if not self.__subscribers:
+                    self.__thread = None
+                    return
+            self.__poll()
+            time.sleep(self.__interval)
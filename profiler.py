@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def collapsed_stack(frame):
+    """return the stack of frame as "outer;...;inner", one "function (file:line)" each"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def collapsed(stacks):
+    """the flame graph input: one "stack count" line per stack, most frequent first"""
+    return "".join("%s %d\n" % (stack, count) for stack, count in stacks.most_common())
+
+
+class Sampler:
+    """Wall clock sampling profiler of the threads of this process
+
+    Every `interval` seconds the stack of each thread (or of the given ones)
+    is read with sys._current_frames() and counted, nothing runs in the
+    sampled threads. Only one profile at a time runs in a process.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.__lock = threading.Lock()
+
+    def sample(self, duration, threads=None, stop=None):
+        """sample for duration seconds, or until stop is set, return a Counter of the stacks"""
+        if not self.__lock.acquire(False):
+            raise ProfilerBusy("a profile is already running")
+        try:
+            me = threading.get_ident()
+            stacks = Counter()
+            deadline = time.time() + duration
+            while time.time() < deadline and not (stop and stop.is_set()):
+                for ident, frame in sys._current_frames().items():
+                    if ident != me and (threads is None or ident in threads):
+                        stacks[collapsed_stack(frame)] += 1
+                if stop:
+                    stop.wait(self.interval)
+                else:
+                    time.sleep(self.interval)
+            return stacks
+        finally:
+            self.__lock.release()
+
+
+class RequestProfile:
+    """Sample the calling thread from another one until stop() is called"""
+
+    def __init__(self, sampler, max_duration=60):
+        self.__sampler = sampler
+        self.__max_duration = max_duration
+        self.__thread_id = threading.get_ident()
+        self.__stop = threading.Event()
+        self.__stacks = None
+        self.error = None
+        self.__thread = threading.Thread(target=self.__run, name="profile")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        try:
+            self.__stacks = self.__sampler.sample(self.__max_duration, set([ self.__thread_id ]), self.__stop)
+        except ProfilerBusy as e:
+            self.error = str(e)
+
+    def stop(self):
+        """return the Counter of the stacks, raise ProfilerBusy if another profile was running"""
+        self.__stop.set()
+        self.__thread.join()
+        if self.error:
+            raise ProfilerBusy(self.error)
+        return self.__stacks
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+import atexit
+import os
+import threading
+import time
+
+from toolbox import save_cache_pickle, load_cache_pickle
+
+
+class Snapshot:
+    """Caches saved to a file every `interval` seconds, and loaded back at startup
+
+    Each cache is registered with a function returning its content and one
+    taking it back. The file holds { "version", "time", "caches": { name:
+    content } }; a file of another VERSION is ignored, as are the caches
+    whose loading fails, they just start empty.
+
+    The file is a pickle: its directory must only be writable by lg.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename, interval=60, logger=None):
+        self.filename = filename
+        self.interval = interval
+        self.logger = logger
+        self.__caches = {}
+        self.__pid = None
+        self.__lock = threading.Lock()
+        self.saved = None
+        self.loaded = None
+        self.error = None
+
+    def register(self, name, dump, load):
+        self.__caches[name] = (dump, load)
+
+    def load(self):
+        if not self.filename:
+            return
+        data = load_cache_pickle(self.filename)
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return
+        for name, content in data.get("caches", {}).items():
+            if name not in self.__caches:
+                continue
+            try:
+                self.__caches[name][1](content)
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning("snapshot: %s not loaded: %s", name, e)
+        self.loaded = data.get("time")
+
+    def save(self):
+        if not self.filename:
+            return
+        caches = {}
+        for name, (dump, load) in self.__caches.items():
+            caches[name] = dump()
+        try:
+            save_cache_pickle(self.filename, { "version": self.VERSION, "time": time.time(), "caches": caches })
+        except (IOError, OSError) as e:
+            # once, not at every interval (the message names a temporary file)
+            error = e.strerror or str(e)
+            if self.logger and self.error != error:
+                self.logger.warning("snapshot: can't write %s: %s", self.filename, e)
+            self.error = error
+            return
+        self.error = None
+        self.saved = time.time()
+
+    def start(self):
+        """save periodically and at exit, from the process calling it"""
+        if not self.filename or self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+        t = threading.Thread(target=self.__loop, name="snapshot")
+        t.daemon = True
+        t.start()
+        atexit.register(self.__exit, self.__pid)
+
+    def __exit(self, pid):
+        # not in the children forked afterwards
+        if pid == os.getpid():
+            self.save()
+
+    def __loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
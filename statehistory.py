@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA
+#
+###
+
+from array import array
+import fcntl
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from toolbox import save_cache_pickle, load_cache_pickle
+
+# magic, version, size, records written since the file was created
+HEADER = struct.Struct("<4sIIQ12x")
+MAGIC = b"LGSH"
+VERSION = 1
+# time, protocol id, state id
+COLUMNS = ("d", "I", "B")
+
+# the part of the info column kept with the state
+BGP_STATES = ("Idle", "Connect", "Active", "OpenSent", "OpenConfirm", "Established", "Passive")
+REMOVED = "removed"
+
+
+def parse_protocols(text):
+    """return (name, state, since) of each protocol of a "show protocols" output
+
+    state is the bird state, followed by the BGP state if any ("start Active").
+    """
+    rows = []
+    for line in text.split("\n")[1:]:
+        split = line.split()
+        if len(split) < 5:
+            continue
+        since, info = split[4], split[5:]
+        # 'timeformat protocol iso long'
+        if info and re.match(r'\d\d:\d\d:\d\d', info[0]):
+            since = "%s %s" % (since, info.pop(0))
+        state = split[3]
+        if info and info[0] in BGP_STATES:
+            state = "%s %s" % (state, info[0])
+        rows.append((split[0], state, since))
+    return rows
+
+
+class StateHistory:
+    """Ring buffer of the protocol state changes of one bird
+
+    Each change is a (time, protocol id, state id) record, kept in three
+    columns of `size` items: arrays in a file mapped in memory when filename
+    is set, plain arrays else. Once full, the oldest records are overwritten.
+    The protocol and state names are numbered in the order they are seen,
+    and saved next to the file.
+
+    Only the process holding the lock on the file records changes, the
+    others can still query it, and take its place when it exits.
+    """
+
+    def __init__(self, filename=None, size=100000):
+        self.filename = filename
+        self.size = size
+        self.__lock = threading.Lock()
+        self.protocols = []
+        self.states = []
+        self.__ids = ({}, {})
+        # protocol -> (state, since), since is None when read back from the file
+        self.last = {}
+        self.writer = True
+        self.written = 0
+        if filename:
+            self.__open()
+        else:
+            self.__mmap = None
+            self.columns = [ array(typecode, [0]) * size for typecode in COLUMNS ]
+        self.__restore()
+
+    def __open(self):
+        length = HEADER.size + sum(array(typecode).itemsize for typecode in COLUMNS) * self.size
+        self.__fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.writer = False
+        if self.writer and os.fstat(self.__fd).st_size != length:
+            os.ftruncate(self.__fd, 0)
+            os.ftruncate(self.__fd, length)
+        self.__mmap = mmap.mmap(self.__fd, length)
+
+        magic, version, size, written = HEADER.unpack_from(self.__mmap)
+        if (magic, version, size) != (MAGIC, VERSION, self.size):
+            written = 0
+            if self.writer:
+                HEADER.pack_into(self.__mmap, 0, MAGIC, VERSION, self.size, 0)
+        self.written = written
+
+        self.columns = []
+        offset = HEADER.size
+        view = memoryview(self.__mmap)
+        for typecode in COLUMNS:
+            itemsize = array(typecode).itemsize
+            self.columns.append(view[offset:offset + itemsize * self.size].cast(typecode))
+            offset += itemsize * self.size
+
+    def take_over(self):
+        """try to become the writer of the file, once the process that held it exited
+
+        return whether this process records the changes
+        """
+        if self.writer:
+            return True
+        with self.__lock:
+            try:
+                fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            length = len(self.__mmap)
+            # only grown: the other readers may have mapped it whole
+            if os.fstat(self.__fd).st_size < length:
+                os.ftruncate(self.__fd, length)
+            magic, version, size, written = HEADER.unpack_from(self.__mmap)
+            if (magic, version, size) != (MAGIC, VERSION, self.size):
+                HEADER.pack_into(self.__mmap, 0, MAGIC, VERSION, self.size, 0)
+            # catch up with the last writer before recording after it
+            self.__load_names()
+            self.__follow()
+            self.writer = True
+        return True
+
+    def __load_names(self):
+        names = load_cache_pickle(self.filename + ".names", {})
+        self.protocols = names.get("protocols", [])
+        self.states = names.get("states", [])
+        self.__ids = tuple(dict((name, i) for i, name in enumerate(l)) for l in (self.protocols, self.states))
+
+    def __restore(self):
+        """rebuild the last state of each protocol from the records"""
+        if self.filename:
+            self.__load_names()
+        self.__followed = 0
+        self.__follow()
+
+    def __follow(self):
+        """apply the records written since the last call to the last states"""
+        start, end = self.__bounds()
+        for j in range(max(start, self.__followed), end):
+            t, protocol, state = self.__record(j)
+            if state == REMOVED:
+                self.last.pop(protocol, None)
+            else:
+                self.last[protocol] = (state, None)
+        self.__followed = end
+
+    def __id(self, kind, name):
+        ids = self.__ids[kind]
+        if name not in ids:
+            names = (self.protocols, self.states)[kind]
+            # the state column is a uint8, the last id is for "other"
+            if kind == 1 and len(names) >= 255:
+                name = "other"
+                if name in ids:
+                    return ids[name]
+            ids[name] = len(names)
+            names.append(name)
+            if self.filename:
+                save_cache_pickle(self.filename + ".names", { "protocols": self.protocols, "states": self.states })
+        return ids[name]
+
+    def __append(self, t, protocol, state):
+        i = self.written % self.size
+        self.columns[0][i] = t
+        self.columns[1][i] = self.__id(0, protocol)
+        self.columns[2][i] = self.__id(1, state)
+        self.written += 1
+        if self.__mmap:
+            HEADER.pack_into(self.__mmap, 0, MAGIC, VERSION, self.size, self.written)
+
+    def update(self, rows, t=None):
+        """record the changes since the last update, return their number
+
+        rows are (name, state, since) as returned by parse_protocols(). A new
+        `since` with the same state is a change missed between two updates.
+        """
+        if not self.writer:
+            return 0
+        if t is None:
+            t = time.time()
+        changes = 0
+        with self.__lock:
+            seen = set()
+            for name, state, since in rows:
+                seen.add(name)
+                old = self.last.get(name)
+                if old is None or old[0] != state or (old[1] is not None and old[1] != since):
+                    self.__append(t, name, state)
+                    changes += 1
+                self.last[name] = (state, since)
+            for name in [ name for name in self.last if name not in seen ]:
+                self.__append(t, name, REMOVED)
+                del self.last[name]
+                changes += 1
+        return changes
+
+    def __bounds(self):
+        if self.__mmap and not self.writer:
+            self.written = HEADER.unpack_from(self.__mmap)[3]
+        return max(0, self.written - self.size), self.written
+
+    def __search(self, t, start, end):
+        """first record index from start whose time is >= t"""
+        times = self.columns[0]
+        while start < end:
+            middle = (start + end) // 2
+            if times[middle % self.size] < t:
+                start = middle + 1
+            else:
+                end = middle
+        return start
+
+    def __record(self, j):
+        i = j % self.size
+        protocol, state = self.columns[1][i], self.columns[2][i]
+        if protocol >= len(self.protocols) or state >= len(self.states):
+            # written by another process since the names were read
+            self.__load_names()
+        return self.columns[0][i], self.protocols[protocol], self.states[state]
+
+    def records(self, since=None, until=None):
+        """yield (time, protocol, state) from since to until, oldest first"""
+        start, end = self.__bounds()
+        if since is not None:
+            start = self.__search(since, start, end)
+        if until is not None:
+            end = self.__search(until, start, end)
+        for j in range(start, end):
+            yield self.__record(j)
+
+    def states_at(self, t, protocols):
+        """return the state of each of protocols at t, from its last change before
+
+        The records are read back from t, until all of them are found.
+        """
+        start, end = self.__bounds()
+        wanted = set(protocols)
+        states = {}
+        j = self.__search(t, start, end)
+        while wanted and j > start:
+            j -= 1
+            record_time, protocol, state = self.__record(j)
+            if protocol in wanted:
+                states[protocol] = state
+                wanted.discard(protocol)
+        return states
+
+    def oldest(self):
+        start, end = self.__bounds()
+        if start == end:
+            return None
+        return self.columns[0][start % self.size]
+
+    def query(self, since, until, protocol=None):
+        """return the changes of each protocol between since and until
+
+        With the state at since (from the previous change, if still kept),
+        the number of times it went down from up, and the part of the time
+        it spent up, from since or from the first change known. The changes
+        are found by binary search on since, the states at since of the
+        protocols changed since then by reading back from there.
+        """
+        changes = []
+        names = set()
+        for t, name, state in self.records(since):
+            if protocol and name != protocol:
+                continue
+            # also the protocols removed after until
+            names.add(name)
+            if t < until:
+                changes.append((t, name, state))
+        with self.__lock:
+            if not self.writer:
+                # the protocols seen by the writer since
+                self.__follow()
+            # unchanged since then, no need to read back their state
+            unchanged = dict((name, last[0]) for name, last in self.last.items() if name not in names and (not protocol or name == protocol))
+
+        protocols = {}
+        initial = self.states_at(since, names)
+        initial.update(unchanged)
+        for name, state in initial.items():
+            protocols[name] = { "initial": state, "changes": [], "flaps": 0, "up": 0.0 }
+        for t, name, state in changes:
+            p = protocols.setdefault(name, { "initial": None, "changes": [], "flaps": 0, "up": 0.0 })
+            previous = p["changes"] and p["changes"][-1][1] or p["initial"]
+            if previous and previous.startswith("up") and not state.startswith("up"):
+                p["flaps"] += 1
+            p["changes"].append((t, state))
+
+        for p in protocols.values():
+            state, start = p["initial"], since
+            if state is None and p["changes"]:
+                start = p["changes"][0][0]
+            known = start
+            for t, new_state in p["changes"]:
+                if state and state.startswith("up"):
+                    p["up"] += t - start
+                state, start = new_state, t
+            if state and state.startswith("up"):
+                p["up"] += until - start
+            up = p.pop("up")
+            p["uptime"] = None
+            if until > known:
+                p["uptime"] = up / (until - known)
+        return protocols
+
+    def stats(self):
+        start, end = self.__bounds()
+        return { "records": end - start, "size": self.size, "protocols": len(self.last), "writer": self.writer }
+
+
+class HistorySampler:
+    """Thread feeding a StateHistory with the "show protocols" of a bird every `interval` seconds"""
+
+    def __init__(self, history, bird, interval=30, logger=None):
+        self.history = history
+        self.__bird = bird
+        self.__interval = interval
+        self.__logger = logger
+        self.error = None
+        self.samples = 0
+
+    def sample(self):
+        status, text = self.__bird.cmd("show protocols")
+        if not status:
+            raise IOError(text)
+        self.samples += 1
+        return self.history.update(parse_protocols(text))
+
+    def start(self):
+        t = threading.Thread(target=self.__loop, name="history")
+        t.daemon = True
+        t.start()
+
+    def __loop(self):
+        while True:
+            try:
+                # a reader waits for the writer to exit, then takes its place
+                if self.history.take_over():
+                    self.sample()
+                self.error = None
+            except Exception as e:
+                if self.__logger and self.error != str(e):
+                    self.__logger.warning("protocol history: %s", e)
+                self.error = str(e)
+            time.sleep(self.__interval)
@@ -0,0 +1,191 @@
+/*
+ * Draw the bgp map in the browser, from the graph sent by lg.py (see
+ * bgpmap_json()): nodes are put in layers by distance from the hosts,
+ * ordered in each layer by the position of their predecessors, then drawn
+ * as svg with the colors of the graphviz rendering.
+ */
+
+var BGPMAP_LAYER_HEIGHT = 90;
+var BGPMAP_NODE_SPACING = 20;
+var BGPMAP_FILL = { "host": "#F5A9A9", "preferred": "#F5A9A9", "other": "white" };
+var SVG_NS = "http://www.w3.org/2000/svg";
+
+function svg_element(name, attrs, parent){
+	var elem = document.createElementNS(SVG_NS, name);
+	for (var k in attrs) {
+		elem.setAttribute(k, attrs[k]);
+	}
+	if (parent) {
+		parent.appendChild(elem);
+	}
+	return elem;
+}
+
+function svg_text(text, x, y, attrs, parent){
+	var elem = svg_element("text", Object.assign({ "x": x, "y": y, "text-anchor": "middle", "font-family": "Times,serif" }, attrs), parent);
+	elem.textContent = text;
+	return elem;
+}
+
+function bgpmap_layers(graph){
+	/* breadth first from the nodes without predecessors, loops are cut */
+	var n = graph.nodes.length;
+	var successors = [], predecessors = [], layer = [];
+	for (var i = 0; i < n; i++) {
+		successors.push([]);
+		predecessors.push([]);
+		layer.push(-1);
+	}
+	graph.edges.forEach(function(e){
+		successors[e[0]].push(e[1]);
+		predecessors[e[1]].push(e[0]);
+	});
+
+	var queue = [];
+	for (var i = 0; i < n; i++) {
+		if (!predecessors[i].length) {
+			layer[i] = 0;
+			queue.push(i);
+		}
+	}
+	for (var i = 0; i < n; i++) {
+		/* a loop with no way in, start from its first node */
+		if (layer[i] == -1 && queue.length == 0) {
+			layer[i] = 0;
+			queue.push(i);
+		}
+		while (queue.length) {
+			var node = queue.shift();
+			successors[node].forEach(function(s){
+				if (layer[s] == -1) {
+					layer[s] = layer[node] + 1;
+					queue.push(s);
+				}
+			});
+		}
+	}
+
+	var layers = [];
+	layer.forEach(function(l, i){
+		while (layers.length <= l) {
+			layers.push([]);
+		}
+		layers[l].push(i);
+	});
+	return { "layers": layers, "layer": layer, "predecessors": predecessors };
+}
+
+function bgpmap_layout(graph){
+	var l = bgpmap_layers(graph);
+	var sizes = graph.nodes.map(function(node){
+		var lines = node[1].split("\r");
+		var width = Math.max.apply(null, lines.map(function(line){ return line.length; }));
+		return { "lines": lines, "width": width * 6 + 16, "height": lines.length * 13 + 10 };
+	});
+
+	/* order each layer by the mean position of the predecessors */
+	var position = [];
+	l.layers.forEach(function(nodes, depth){
+		if (depth > 0) {
+			nodes.forEach(function(node){
+				var p = l.predecessors[node].filter(function(pred){ return l.layer[pred] < depth; });
+				position[node] = p.length ? p.reduce(function(sum, pred){ return sum + position[pred]; }, 0) / p.length : 0;
+			});
+			nodes.sort(function(a, b){ return position[a] - position[b]; });
+		}
+		nodes.forEach(function(node, i){ position[node] = i; });
+	});
+
+	/* then place them, each layer centered */
+	var x = [], y = [], width = 0;
+	l.layers.forEach(function(nodes){
+		var w = nodes.reduce(function(sum, node){ return sum + sizes[node].width + BGPMAP_NODE_SPACING; }, 0);
+		width = Math.max(width, w);
+	});
+	l.layers.forEach(function(nodes, depth){
+		var w = nodes.reduce(function(sum, node){ return sum + sizes[node].width + BGPMAP_NODE_SPACING; }, 0);
+		var left = (width - w) / 2;
+		nodes.forEach(function(node){
+			x[node] = left + (sizes[node].width + BGPMAP_NODE_SPACING) / 2;
+			y[node] = depth * BGPMAP_LAYER_HEIGHT + 40;
+			left += sizes[node].width + BGPMAP_NODE_SPACING;
+		});
+	});
+	return { "x": x, "y": y, "sizes": sizes, "width": width, "height": l.layers.length * BGPMAP_LAYER_HEIGHT + 20 };
+}
+
+function draw_bgpmap(container, graph){
+	var pos = bgpmap_layout(graph);
+	var svg = svg_element("svg", { "width": pos.width, "height": pos.height, "viewBox": "0 0 " + pos.width + " " + pos.height }, container);
+	svg_element("rect", { "width": pos.width, "height": pos.height, "fill": "white" }, svg);
+
+	var defs = svg_element("defs", {}, svg);
+	var colors = {};
+	function arrow(color){
+		if (!colors[color]) {
+			colors[color] = "arrow" + Object.keys(colors).length;
+			var marker = svg_element("marker", { "id": colors[color], "viewBox": "0 0 10 10", "refX": 10, "refY": 5, "markerWidth": 6, "markerHeight": 6, "orient": "auto" }, defs);
+			svg_element("path", { "d": "M 0 0 L 10 5 L 0 10 z", "fill": color }, marker);
+		}
+		return "url(#" + colors[color] + ")";
+	}
+
+	function box(node){
+		var s = pos.sizes[node];
+		return { "left": pos.x[node] - s.width / 2, "right": pos.x[node] + s.width / 2, "top": pos.y[node] - s.height / 2, "bottom": pos.y[node] + s.height / 2 };
+	}
+
+	graph.clusters.forEach(function(cluster){
+		var boxes = cluster[1].map(box);
+		var left = Math.min.apply(null, boxes.map(function(b){ return b.left; })) - 8;
+		var right = Math.max.apply(null, boxes.map(function(b){ return b.right; })) + 8;
+		var top = Math.min.apply(null, boxes.map(function(b){ return b.top; })) - 8;
+		var bottom = Math.max.apply(null, boxes.map(function(b){ return b.bottom; })) + 8;
+		svg_element("rect", { "x": left, "y": top, "width": right - left, "height": bottom - top, "fill": "#F5A9A9", "fill-opacity": 0.3, "stroke": "black" }, svg);
+	});
+
+	graph.edges.forEach(function(e){
+		var src = box(e[0]), dst = box(e[1]);
+		var x1 = pos.x[e[0]], y1 = src.bottom, x2 = pos.x[e[1]], y2 = dst.top;
+		if (y2 <= y1) {
+			/* back to an upper layer */
+			y1 = src.top;
+			y2 = dst.bottom;
+		}
+		var my = (y1 + y2) / 2;
+		var preferred = e[2] == "red";
+		svg_element("path", {
+			"d": "M " + x1 + " " + y1 + " C " + x1 + " " + my + " " + x2 + " " + my + " " + x2 + " " + y2,
+			"fill": "none",
+			"stroke": e[2],
+			"stroke-width": preferred ? 2 : 1,
+			"stroke-dasharray": preferred ? "" : "5,2",
+			"marker-end": arrow(e[2]),
+		}, svg);
+		e[3].forEach(function(label, i){
+			svg_text(label, (x1 + x2) / 2 + 4, my + i * 9, { "font-size": 7, "text-anchor": "start" }, svg);
+		});
+	});
+
+	graph.nodes.forEach(function(node, i){
+		var b = box(i);
+		var attrs = { "x": b.left, "y": b.top, "width": b.right - b.left, "height": b.bottom - b.top, "fill": BGPMAP_FILL[node[2]], "stroke": "black" };
+		if (node[2] != "host") {
+			attrs.rx = (b.right - b.left) / 2;
+			attrs.ry = (b.bottom - b.top) / 2;
+		}
+		var g = svg_element("g", {}, svg);
+		svg_element("title", {}, g).textContent = node[0];
+		svg_element("rect", attrs, g);
+		pos.sizes[i].lines.forEach(function(line, n){
+			svg_text(line, pos.x[i], b.top + 15 + n * 13, { "font-size": 10 }, g);
+		});
+	});
+
+	graph.prepends.forEach(function(p){
+		var b = box(p[0]);
+		svg_element("path", { "d": "M " + b.right + " " + (pos.y[p[0]] - 4) + " c 18 -10 18 18 0 8", "fill": "none", "stroke": "grey", "marker-end": arrow("grey") }, svg);
+		svg_text(" " + p[1] + "x", b.right + 16, pos.y[p[0]] + 3, { "font-size": 10, "fill": "grey", "text-anchor": "start" }, svg);
+	});
+	return svg;
+}
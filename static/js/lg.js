@@ -52,7 +52,7 @@ $(function(){
 		$(".modal .modal-footer .btn").click(function(){
 			$(".modal").modal('hide'); 
 		});
-		$("a.whois").click(function (event){
+		$(document).on("click", "a.whois", function (event){
 			event.preventDefault();
 			link = $(this).attr('href');
 			$.getJSON(link, function(data) {
@@ -99,6 +99,123 @@ $(function(){
         "bPaginate": false,
 	} );
 
+	load_pending(30);
+	watch_summary();
+	watch_traceroute();
 });
 
+/* hosts that didn't answer before the page deadline, fetch them again */
+function load_pending(tries){
+	$(".host-pending").each(function(){
+		load_pending_host($(this), tries);
+	});
+}
+
+function load_pending_host(elem, tries){
+	$.get(elem.data("url"), function(html){
+		var page = $("<div>").append($.parseHTML(html));
+		var result = page.find(".host-result[data-host='" + elem.data("host") + "']");
+		if (result.hasClass("host-pending")) {
+			if (tries > 1) setTimeout(function(){ load_pending_host(elem, tries - 1); }, 1000);
+			return;
+		}
+		if (!result.length) {
+			result = $("<div>").addClass("alert alert-warning").text(page.find(".alert").text());
+		}
+		elem.replaceWith(result);
+		result.find(".table-summary").dataTable({ "bPaginate": false });
+	}).fail(function(xhr){
+		/* over the rate limit: try again when the server says so */
+		if (xhr.status == 429 && tries > 1) {
+			var retry = parseInt(xhr.getResponseHeader("Retry-After")) || 1;
+			setTimeout(function(){ load_pending_host(elem, tries - 1); }, retry * 1000);
+			return;
+		}
+		elem.replaceWith($("<div>").addClass("alert alert-warning").text(elem.data("host") + ": " + (xhr.status == 429 ? "too many requests, reload the page later" : "no answer")));
+	});
+}
+
+/* live summary: patch the protocol rows that changed, pushed by the server */
+function state_badge(row){
+	var badge = "danger";
+	if (row.state == "up") badge = "success";
+	else if (row.state == "down") badge = "default";
+	else if (row.state == "start" && row.info == "Passive") badge = "info";
+	return $("<span>").addClass("badge badge-" + badge).text(row.state);
+}
+
+function summary_row(host, row){
+	var link = $("<a>").attr("href", "/detail/" + host + (proto ? "/" + proto : "") + "?q=" + encodeURIComponent(row.name)).text(row.name);
+	return $("<tr>").attr("data-name", row.name).append(
+		$("<td>").append(link),
+		$("<td>").text(row.proto),
+		$("<td>").append(state_badge(row)),
+		$("<td>").text(row.since),
+		$("<td>").text(row.info)
+	);
+}
+
+function patch_summary(message){
+	var table = $(".host-result[data-host='" + message.name + "'] .table-summary");
+	if (!table.length || message.error) return;
+	var dt = table.DataTable();
+	$.each(message.rows, function(i, row){
+		var tr = table.find("tr").filter(function(){ return $(this).attr("data-name") == row.name; });
+		if (tr.length) {
+			var cells = tr.children("td");
+			cells.eq(1).text(row.proto);
+			cells.eq(2).empty().append(state_badge(row));
+			cells.eq(3).text(row.since);
+			cells.eq(4).text(row.info);
+			dt.row(tr).invalidate("dom");
+		} else {
+			dt.row.add(summary_row(message.name, row));
+		}
+	});
+	$.each(message.removed, function(i, name){
+		dt.row(table.find("tr").filter(function(){ return $(this).attr("data-name") == name; })).remove();
+	});
+	dt.draw(false);
+}
+
+function watch_summary(){
+	if (request_type != "summary" || !window.EventSource || !$(".table-summary").length) return;
+	var source = new EventSource("/summary_events/" + hosts + (proto ? "/" + proto : ""));
+	source.onmessage = function(event){
+		patch_summary(JSON.parse(event.data));
+	};
+	/* the browser doesn't reconnect after an error answer, like a 429 */
+	source.onerror = function(){
+		if (source.readyState == EventSource.CLOSED) setTimeout(watch_summary, 10000);
+	};
+}
 
+/* hops of the traceroutes of all the hosts, appended as they come */
+function watch_traceroute(){
+	var container = $(".traceroute");
+	if (!container.length || !window.EventSource) return;
+	var source = new EventSource(container.data("events"));
+	var received = false;
+	source.onmessage = function(event){
+		received = true;
+		var message = JSON.parse(event.data);
+		if (message.end) {
+			source.close();
+			return;
+		}
+		var elem = container.find(".traceroute-host").filter(function(){ return $(this).data("host") == message.host; });
+		if (message.line != undefined) {
+			var pre = elem.find("pre");
+			pre.text(pre.text() + (pre.text() ? "\n" : "") + message.line);
+		}
+		if (message.done) {
+			elem.find(".traceroute-status").text(message.error || "");
+		}
+	};
+	/* a new connection would run the traceroutes again */
+	source.onerror = function(){
+		var started = source.readyState != EventSource.CLOSED || received;
+		source.close();
+		container.find(".traceroute-status").filter(function(){ return $(this).text() == "running..."; }).text(started ? "connection lost" : "refused, too many requests? reload the page later");
+	};
+}
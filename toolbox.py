@@ -19,17 +19,40 @@
 #
 ###
 
-from dns import resolver
+import os
 import socket
 import pickle
-import xml.parsers.expat
-
-resolv = resolver.Resolver()
-resolv.timeout = 0.5
-resolv.lifetime = 1
+import tempfile
+import time
+
+# dnspython and expat are imported on first use, most requests need neither
+resolv = None
+
+# answers of resolve(): (name, type) -> (result, expiration time)
+dns_cache = {}
+DNS_CACHE_SIZE = 10000
+
+def resolver():
+    global resolv
+    if resolv is None:
+        from dns import resolver
+        r = resolver.Resolver()
+        r.timeout = 0.5
+        r.lifetime = 1
+        resolv = r
+    return resolv
 
 def resolve(n, q):
-	return str(resolv.query(n,q)[0])
+	cached = dns_cache.get((n, q))
+	if cached and cached[1] > time.time():
+		return cached[0]
+	answer = resolver().query(n,q)
+	result = str(answer[0])
+	if len(dns_cache) >= DNS_CACHE_SIZE:
+		# the oldest entry
+		dns_cache.pop(next(iter(dns_cache)), None)
+	dns_cache[(n, q)] = (result, answer.expiration)
+	return result
 
 def resolve_any(h):
     try:
@@ -66,9 +89,17 @@ def ipv6_is_valid(n):
         return False
 
 def save_cache_pickle(filename, data):
-	output = open(filename, 'wb')
-	pickle.dump(data, output)
-	output.close()
+	"""write data to filename atomically, readers get the old or the new file"""
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".%s." % os.path.basename(filename))
+	try:
+		with os.fdopen(fd, 'wb') as output:
+			pickle.dump(data, output, pickle.HIGHEST_PROTOCOL)
+			output.flush()
+			os.fsync(output.fileno())
+		os.replace(tmp, filename)
+	except:
+		os.unlink(tmp)
+		raise
 
 def load_cache_pickle(filename, default = None):
 	try:
@@ -83,6 +114,8 @@ def load_cache_pickle(filename, default = None):
 	return data
 
 def unescape(s):
+    import xml.parsers.expat
+
     want_unicode = False
     if isinstance(s, str):
         s = s.encode("utf-8")